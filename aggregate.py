@@ -0,0 +1,118 @@
+# Compiles /api/aggregate requests into parameterized SQL over the Inscricoes
+# star schema. Only the dimensions, measures and joins listed here can reach
+# SQLite; the request supplies nothing but names from these tables and the
+# code values bound as parameters.
+
+# Joins in dependency order; a dimension lists every join it needs
+JOINS = {
+    'anoletivo': 'JOIN AnoLetivo A ON A.CODAnoLetivo = I.CODAnoLetivo',
+    'entidade': 'JOIN Entidade E ON E.CODEntidade = I.CODEntidade',
+    'rede': 'JOIN Rede R ON R.CODRede = E.CODRede',
+    'natureza': 'JOIN Natureza NA ON NA.CODNatureza = E.CODNatureza',
+    'tipologia': 'JOIN Tipologia T ON T.CODTipologia = E.CODTipologia',
+    'organizacao': 'JOIN Organizacao O ON O.CODOrganizacao = I.CODOrganizacao',
+    'anoescolaridade': 'JOIN AnoEscolaridade AE ON AE.CODAnoEscolaridade = I.CODAnoEscolaridade',
+    'nivelensino': 'JOIN NivelEnsino N ON N.CODNivelEnsino = I.CODNivelEnsino',
+    'oferta': 'JOIN Oferta OFR ON OFR.CODOferta = I.CODOferta',
+    'curso': 'JOIN Cursos CU ON CU.CODCurso = I.CODCurso',
+    'orientacao': 'JOIN Orientacao ORI ON ORI.CODOrientacao = I.CODOrientacao',
+    'cicloestudos': 'JOIN CicloEstudos CE ON CE.CODCicloEstudos = I.CODCicloEstudos',
+    'sexo': 'JOIN Sexo S ON S.CODSexo = I.CODSexo',
+    'localizacao': 'JOIN Localizacao L ON L.CODEntidade = I.CODEntidade',
+    'concelho': 'JOIN Concelho C ON C.CODConcelho = L.CODConcelho',
+    'distrito': 'JOIN Distrito D ON D.CODDistrito = C.CODDistrito',
+    'nutsiii': 'JOIN NUTSIII N3 ON N3.CODNUTSIII = C.CODNUTSIII',
+    'nutsii': 'JOIN NUTSII N2 ON N2.CODNUTSII = N3.CODNUTSII',
+}
+
+# name: (code expression, code alias, label expression, label alias, joins)
+DIMENSIONS = {
+    'anoletivo': ('I.CODAnoLetivo', 'CODAnoLetivo', 'A.AnoLetivo', 'AnoLetivo', ['anoletivo']),
+    'entidade': ('I.CODEntidade', 'CODEntidade', 'E.Entidade', 'Entidade', ['entidade']),
+    'rede': ('E.CODRede', 'CODRede', 'R.Rede', 'Rede', ['entidade', 'rede']),
+    'natureza': ('E.CODNatureza', 'CODNatureza', 'NA.Natureza', 'Natureza', ['entidade', 'natureza']),
+    'tipologia': ('E.CODTipologia', 'CODTipologia', 'T.Tipologia', 'Tipologia', ['entidade', 'tipologia']),
+    'organizacao': ('I.CODOrganizacao', 'CODOrganizacao', 'O.Organizacao', 'Organizacao', ['organizacao']),
+    'anoescolaridade': ('I.CODAnoEscolaridade', 'CODAnoEscolaridade', 'AE.AnoEscolaridade', 'AnoEscolaridade',
+                        ['anoescolaridade']),
+    'nivelensino': ('I.CODNivelEnsino', 'CODNivelEnsino', 'N.NivelEnsino', 'NivelEnsino', ['nivelensino']),
+    'oferta': ('I.CODOferta', 'CODOferta', 'OFR.Oferta', 'Oferta', ['oferta']),
+    'curso': ('I.CODCurso', 'CODCurso', 'CU.Curso', 'Curso', ['curso']),
+    'orientacao': ('I.CODOrientacao', 'CODOrientacao', 'ORI.Orientacao', 'Orientacao', ['orientacao']),
+    'cicloestudos': ('I.CODCicloEstudos', 'CODCicloEstudos', 'CE.CicloEstudos', 'CicloEstudos', ['cicloestudos']),
+    'sexo': ('I.CODSexo', 'CODSexo', 'S.Sexo', 'Sexo', ['sexo']),
+    'concelho': ('L.CODConcelho', 'CODConcelho', 'C.Concelho', 'Concelho', ['localizacao', 'concelho']),
+    'distrito': ('C.CODDistrito', 'CODDistrito', 'D.Distrito', 'Distrito', ['localizacao', 'concelho', 'distrito']),
+    'nutsiii': ('C.CODNUTSIII', 'CODNUTSIII', 'N3.NUTSIII', 'NUTSIII', ['localizacao', 'concelho', 'nutsiii']),
+    'nutsii': ('N3.CODNUTSII', 'CODNUTSII', 'N2.NUTSII', 'NUTSII',
+               ['localizacao', 'concelho', 'nutsiii', 'nutsii']),
+}
+
+# Filters on a dimension need the joins up to its code expression only
+FILTER_JOINS = {
+    'rede': ['entidade'],
+    'natureza': ['entidade'],
+    'tipologia': ['entidade'],
+    'concelho': ['localizacao'],
+    'distrito': ['localizacao', 'concelho'],
+    'nutsiii': ['localizacao', 'concelho'],
+    'nutsii': ['localizacao', 'concelho', 'nutsiii'],
+}
+
+MEASURES = {
+    'alunos': 'SUM(I.NumeroAlunosMatriculados) AS TotalAlunos',
+    'entidades': 'COUNT(DISTINCT I.CODEntidade) AS TotalEntidades',
+}
+
+MAX_DIMENSIONS = 3
+MAX_FILTER_VALUES = 50
+
+
+# Canonical form of a request: dimensions deduplicated in DIMENSIONS order,
+# filters sorted by name with sorted, deduplicated integer codes. Equivalent
+# requests normalize to the same key, which is also the cache key.
+def normalize_request(dims, filters, measure):
+    unknown = [dim for dim in dims if dim not in DIMENSIONS]
+    if unknown:
+        raise ValueError(f"Unknown dimension: {', '.join(unknown)}")
+    dims = tuple(dim for dim in DIMENSIONS if dim in dims)
+    if len(dims) > MAX_DIMENSIONS:
+        raise ValueError(f'At most {MAX_DIMENSIONS} dimensions per request')
+    if measure not in MEASURES:
+        raise ValueError(f'Unknown measure: {measure}')
+    normalized = []
+    for name, values in filters.items():
+        if name not in DIMENSIONS:
+            raise ValueError(f'Unknown filter: {name}')
+        try:
+            codes = tuple(sorted({int(value) for value in values}))
+        except ValueError:
+            raise ValueError(f'Filter {name} takes integer codes')
+        if not codes or len(codes) > MAX_FILTER_VALUES:
+            raise ValueError(f'Filter {name} takes 1 to {MAX_FILTER_VALUES} codes')
+        normalized.append((name, codes))
+    return dims, tuple(sorted(normalized)), measure
+
+
+def compile_query(dims, filters, measure):
+    needed = set()
+    columns = []
+    group_by = []
+    for dim in dims:
+        code, code_alias, label, label_alias, joins = DIMENSIONS[dim]
+        needed.update(joins)
+        columns += [f'{code} AS {code_alias}', f'{label} AS {label_alias}']
+        group_by.append(code)
+    where = []
+    args = []
+    for name, codes in filters:
+        needed.update(FILTER_JOINS.get(name, []))
+        where.append(f"{DIMENSIONS[name][0]} IN ({', '.join('?' * len(codes))})")
+        args += codes
+    sql = ' '.join(
+        [f"SELECT {', '.join(columns + [MEASURES[measure]])} FROM Inscricoes I"]
+        + [clause for name, clause in JOINS.items() if name in needed]
+        + ([f"WHERE {' AND '.join(where)}"] if where else [])
+        + ([f"GROUP BY {', '.join(group_by)} ORDER BY {', '.join(group_by)}"] if group_by else [])
+    )
+    return sql, args
@@ -1,8 +1,34 @@
+import functools
+import itertools
 import logging
+import os
+from datetime import datetime, timezone
+import random
+import signal
 import sqlite3
-import re
+import threading
+import time
 import warnings
-from flask import Flask, render_template, abort, g, jsonify
+import zlib
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, after_this_request, render_template, stream_with_context, abort, g, jsonify, request, send_file, url_for
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup, escape
+from reports import REPORTS, summary_table
+from schema import SchemaRegistry, LookupStore, children
+from aggregate import normalize_request, compile_query
+from cube import LEVELS, cube_query
+from snapshots import SnapshotStore
+from search import SEARCHED, match_query, search_sql
+from export import FORMATS, parse_request, export_sql
+from pool import ConnectionPool
+from querystats import QueryStats, TimedCursor, normalize
+from refresher import Refresher
+try:
+    import columnar
+except ImportError:  # NumPy is only needed by the columnar report backend
+    columnar = None
 
 # Suppress FutureWarnings
 warnings.filterwarnings('ignore', category=FutureWarning)
@@ -12,119 +38,499 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 
 # Flask app setup
 APP = Flask(__name__)
+APP.config['DATABASE'] = 'AlunosMatriculados.db'
+# Open the database with mode=ro: the app never writes to it
+APP.config['DATABASE_READ_ONLY'] = True
+# Serve /queries and the charts from live SQL instead of the summary tables
+APP.config['LIVE_REPORTS'] = False
+# Backend of the report routes: 'sqlite', or 'columnar' for the in-memory
+# NumPy engine of columnar.py (also selectable per request with ?backend=)
+APP.config['REPORT_BACKEND'] = 'sqlite'
+# Threads running the /queries reports concurrently, and the seconds each
+# report may take before its section is shown as unavailable
+APP.config['REPORT_WORKERS'] = 4
+APP.config['REPORT_TIMEOUT'] = 10
+# Seconds between two checks of the data version by the background refresher
+APP.config['REFRESH_INTERVAL'] = 5
+# Results per page of /search, and the suggestions and time budget (in
+# milliseconds) of its autocomplete mode
+APP.config['SEARCH_PAGE_SIZE'] = 25
+APP.config['SEARCH_MAX_PAGE'] = 40
+APP.config['AUTOCOMPLETE_SIZE'] = 10
+APP.config['AUTOCOMPLETE_BUDGET_MS'] = 5
+# Rows fetched and written per chunk by the /export routes
+APP.config['EXPORT_BATCH_SIZE'] = 5000
+# Seconds the homepage statistics are served from memory
+APP.config['STATS_CACHE_TTL'] = 300
+# Seconds and number of distinct requests /api/aggregate results are kept
+APP.config['AGGREGATE_CACHE_TTL'] = 300
+APP.config['AGGREGATE_CACHE_SIZE'] = 256
+# Rows per page in /list/<table_name>/ (?size=) and its upper bound
+APP.config['LIST_PAGE_SIZE'] = 100
+APP.config['LIST_MAX_PAGE_SIZE'] = 1000
+APP.config['STREAM_BUFFER_EVENTS'] = 500
+# Record details: child rows listed per page, and the largest referenced
+# table whose labels are kept in memory (larger ones are joined)
+APP.config['CHILD_PAGE_SIZE'] = 20
+APP.config['LOOKUP_MAX_ROWS'] = 1000
+# Directory of the compiled template cache (None: the system temp directory)
+APP.config['TEMPLATE_CACHE_DIR'] = None
+# Seconds browsers and proxies may reuse a response before revalidating it
+# with its ETag (which changes whenever the database file does)
+APP.config['HTTP_CACHE_MAX_AGE'] = 60
+# Responses of at least GZIP_MIN_SIZE bytes are gzipped for clients that accept it
+APP.config['GZIP_LEVEL'] = 6
+APP.config['GZIP_MIN_SIZE'] = 1024
+# Where the export-snapshots command writes the pre-rendered pages
+APP.config['SNAPSHOT_DIR'] = 'snapshots'
+# Statements slower than this are logged with their EXPLAIN QUERY PLAN
+APP.config['SLOW_QUERY_MS'] = 200
+# Fraction of statements logged with their arguments (0 turns it off)
+APP.config['SQL_LOG_SAMPLE'] = 0.0
+# Distinct statements timed separately in /metrics; the others are summed
+# together
+APP.config['QUERY_STATS_MAX'] = 500
+
+PID_FILE = 'app.pid'
+
+# Database connection, taken from the per-thread pool
+POOL = ConnectionPool(APP.config['DATABASE'], APP.config['DATABASE_READ_ONLY'])
 
-# Database connection
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect('AlunosMatriculados.db', check_same_thread=False)
-        g.db.row_factory = sqlite3.Row
-        logging.info('Connected to database')
+        g.db = POOL.connection()
     return g.db
 
+# The connection stays open in the pool for the next request on this thread
 def close_db(exception=None):
-    db = g.pop('db', None)
-    if db:
-        db.close()
-        logging.info('Closed database connection')
+    if g.pop('db', None) is not None:
+        POOL.release()
 
 APP.teardown_appcontext(close_db)
 
+# Timings and row counts of every statement, by fingerprint (see /metrics)
+QUERY_STATS = QueryStats(APP.config['QUERY_STATS_MAX'])
+
 def execute(sql, args=None):
-    sql = re.sub('\s+', ' ', sql)
-    logging.info('SQL: {} Args: {}'.format(sql, args))
-    cur = get_db().cursor()
-    return cur.execute(sql, args) if args else cur.execute(sql)
+    sql = normalize(sql)
+    sample = APP.config['SQL_LOG_SAMPLE']
+    if sample and random.random() < sample:
+        logging.info('SQL: {} Args: {}'.format(sql, args))
+    return TimedCursor(get_db().cursor(), sql, args, QUERY_STATS, APP.config['SLOW_QUERY_MS'] / 1000)
 
 # Jinja2 filters for dynamic content
-@APP.template_filter('startswith')
-def startswith_filter(s, prefix):
-    return str(s).lower().startswith(prefix)
-
-@APP.template_filter('endswith')
-def endswith_filter(s, suffix):
-    return str(s).lower().endswith(suffix)
+# Compiled templates are cached on disk, so that a new process (e.g. every
+# gunicorn worker) loads them instead of compiling them again
+APP.jinja_env.bytecode_cache = FileSystemBytecodeCache(APP.config['TEMPLATE_CACHE_DIR'])
+
+# Static parts of the pages (e.g. the navigation bar of base.html), rendered
+# once per process: {{ fragment('nav.html') }}
+@APP.template_global()
+@functools.lru_cache(maxsize=None)
+def fragment(template_name):
+    return Markup(APP.jinja_env.get_template(template_name).render())
+
+# In-process cache whose entries expire after a configurable TTL; with
+# size_key set, the oldest entries are evicted beyond that many
+class TTLCache:
+    def __init__(self, ttl_key, size_key=None):
+        self.ttl_key = ttl_key
+        self.size_key = size_key
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry and now < entry[0]:
+            return entry[1]
+        value = compute()
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (now + APP.config[self.ttl_key], value)
+            if self.size_key:
+                while len(self._entries) > APP.config[self.size_key]:
+                    del self._entries[next(iter(self._entries))]
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+STATS_CACHE = TTLCache('STATS_CACHE_TTL')
+AGGREGATE_CACHE = TTLCache('AGGREGATE_CACHE_TTL', 'AGGREGATE_CACHE_SIZE')
+SCHEMA = SchemaRegistry()
+LOOKUPS = LookupStore()
+COLUMNAR = columnar.ColumnarStore() if columnar else None
+SNAPSHOTS = SnapshotStore(APP.config['SNAPSHOT_DIR'])
+CACHES = [STATS_CACHE, AGGREGATE_CACHE, SCHEMA, LOOKUPS, POOL, SNAPSHOTS] + ([COLUMNAR] if COLUMNAR else [])
+
+# Tables allowed in the dynamic routes, with their columns and keys
+def schema():
+    return SCHEMA.tables(get_db)
+
+def invalidate_caches():
+    for cache in CACHES:
+        cache.clear()
+    logging.info('Caches invalidated')
+
+# Invalidation hook: the loader sends SIGHUP to the pid in PID_FILE after
+# writing data, which also makes the schema be introspected again and the
+# pooled connections be reopened
+def _reload_signal(signum, frame):
+    invalidate_caches()
+    REFRESHER.wake()
+
+# Start of this process: part of every ETag, so a restart (e.g. with new
+# templates) never revalidates responses rendered by the previous code
+STARTED = time.time_ns()
+
+# Routes whose responses do not depend only on the data
+NO_HTTP_CACHE = {'metrics', 'refresh_status', 'static'}
+
+# Version of the data, from the size and modification time of the database
+# and of its WAL (while it holds any frames): any write by the loader
+# changes it. A stat call, no SQL.
+def db_version():
+    path = APP.config['DATABASE']
+    try:
+        stats = [os.stat(path)]
+    except OSError:
+        return None
+    try:
+        wal = os.stat(path + '-wal')
+        if wal.st_size:
+            stats.append(wal)
+    except OSError:
+        pass
+    return '-'.join(f'{st.st_mtime_ns:x}-{st.st_size:x}' for st in stats), max(st.st_mtime for st in stats)
+
+# None (no HTTP caching) also while the refresher still serves the results
+# of the previous data version
+def data_stamp():
+    version = db_version()
+    if version is None or REFRESHER.stale(version[0]):
+        return None
+    modified = datetime.fromtimestamp(max(version[1], STARTED / 1e9), timezone.utc).replace(microsecond=0)
+    return f'{STARTED:x}-{version[0]}', modified
+
+def http_cacheable():
+    return request.method in ('GET', 'HEAD') and request.endpoint not in NO_HTTP_CACHE
+
+# Compressed responses are other representations and get their own ETag
+def representation_etag(stamp, encoding):
+    return stamp[0] if encoding in (None, 'identity') else f'{stamp[0]}-{encoding}'
+
+def set_cache_headers(response, stamp, etag):
+    response.set_etag(etag)
+    response.last_modified = stamp[1]
+    response.cache_control.public = True
+    response.cache_control.max_age = APP.config['HTTP_CACHE_MAX_AGE']
+    response.vary.add('Accept-Encoding')
+
+# Conditional GET: answer with 304 before the view runs any SQL or template
+@APP.before_request
+def not_modified():
+    if not http_cacheable():
+        return None
+    g.data_stamp = stamp = data_stamp()
+    if stamp is None:
+        return None
+    if request.if_none_match:
+        etags = [representation_etag(stamp, encoding) for encoding in (None, 'gzip', 'br')]
+        etag = next((etag for etag in etags if request.if_none_match.contains_weak(etag)), None)
+    elif request.if_modified_since is not None and request.if_modified_since >= stamp[1]:
+        etag = stamp[0]
+    else:
+        etag = None
+    if etag:
+        response = APP.response_class(status=304)
+        set_cache_headers(response, stamp, etag)
+        return response
+    return None
+
+# Pre-rendered snapshot of the exact URL (see snapshots.py), when there is
+# one of the current data, in the best encoding the client accepts
+@APP.before_request
+def serve_snapshot():
+    if not http_cacheable() or g.get('data_stamp') is None:
+        return None
+    url = request.path + ('?' + request.query_string.decode() if request.query_string else '')
+    version = db_version()
+    snapshot = SNAPSHOTS.lookup(url, version and version[0], lambda encoding: request.accept_encodings[encoding] > 0)
+    if snapshot is None:
+        return None
+    path, encoding, content_type = snapshot
+    response = send_file(os.path.abspath(path), mimetype=content_type, conditional=False, etag=False)
+    if encoding != 'identity':
+        response.content_encoding = encoding
+    return response
+
+# gzip a response body, chunk by chunk for streamed responses. Snapshots are
+# compressed the same way (see snapshots.py), so that a page has the same
+# bytes under its gzip ETag whether it is served live or from a snapshot
+def gzip_chunks(chunks, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def compress(response):
+    if (response.status_code != 200 or response.content_encoding or response.direct_passthrough
+            or request.accept_encodings['gzip'] <= 0):
+        return
+    if response.is_streamed:
+        response.response = gzip_chunks(response.iter_encoded(), APP.config['GZIP_LEVEL'])
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < APP.config['GZIP_MIN_SIZE']:
+            return
+        response.set_data(b''.join(gzip_chunks([body], APP.config['GZIP_LEVEL'])))
+    response.content_encoding = 'gzip'
+    response.vary.add('Accept-Encoding')
+
+@APP.after_request
+def finish_response(response):
+    compress(response)
+    stamp = g.get('data_stamp')
+    if stamp is not None and response.status_code == 200:
+        set_cache_headers(response, stamp, representation_etag(stamp, response.content_encoding))
+    return response
+
+# Keyed on the version of the refresher's results: on_change clears the cache
+# before the recompute, so an entry made meanwhile from the previous results
+# must not be served once the new ones are swapped in
+def index_stats():
+    return STATS_CACHE.get(('index', REFRESHER.served_version()), lambda: dict(report_rows('estatisticas')[0]))
 
 @APP.route('/')
 def index():
     try:
-        # Perform individual queries for each table count
-        stats = {}
-        stats['n_entidades'] = execute('SELECT COUNT(*) FROM Entidade').fetchone()[0]
-        stats['n_anos'] = execute('SELECT COUNT(*) FROM AnoLetivo').fetchone()[0]
-        stats['n_cursos'] = execute('SELECT COUNT(*) FROM Cursos').fetchone()[0]
-        stats['n_ofertas'] = execute('SELECT COUNT(*) FROM Oferta').fetchone()[0]
-        stats['n_organizacoes'] = execute('SELECT COUNT(*) FROM Organizacao').fetchone()[0]
-        stats['n_niveis'] = execute('SELECT COUNT(*) FROM NivelEnsino').fetchone()[0]
-        stats['n_orientacoes'] = execute('SELECT COUNT(*) FROM Orientacao').fetchone()[0]
-        stats['n_ciclos'] = execute('SELECT COUNT(*) FROM CicloEstudos').fetchone()[0]
-        stats['n_sexos'] = execute('SELECT COUNT(*) FROM Sexo').fetchone()[0]
-        stats['n_concelhos'] = execute('SELECT COUNT(*) FROM Concelho').fetchone()[0]
-        stats['n_distritos'] = execute('SELECT COUNT(*) FROM Distrito').fetchone()[0]
-        stats['n_nutsii'] = execute('SELECT COUNT(*) FROM NUTSII').fetchone()[0]
-        stats['n_nutsiii'] = execute('SELECT COUNT(*) FROM NUTSIII').fetchone()[0]
-        stats['n_anoEscolaridade'] = execute('SELECT COUNT(*) FROM AnoEscolaridade').fetchone()[0]
-        stats['n_inscricoes'] = execute('SELECT sum(NumeroAlunosMatriculados) FROM Inscricoes').fetchone()[0]
-        stats['n_localizacao'] = execute('SELECT COUNT(*) FROM Localizacao').fetchone()[0]
-        stats['n_escola'] = execute('SELECT COUNT(*) FROM Escola').fetchone()[0]
-        stats['n_agrupamento'] = execute('SELECT COUNT(*) FROM Agrupamento').fetchone()[0]
-        stats['n_EscolaSede'] = execute('SELECT COUNT(*) FROM EscolaSede').fetchone()[0]
-
-        logging.info(stats)
-        return render_template('index.html', stats=stats)
+        stats = index_stats()
+        # The chart datasets are embedded in the page, so that it needs no
+        # other request; without them the page falls back to /api/charts
+        try:
+            charts = {name: chart_data(name) for name in CHARTS}
+        except Exception as e:
+            logging.error(f"Error retrieving charts: {e}")
+            charts = {}
+        return render_template('index.html', stats=stats, charts=charts)
 
     except Exception as e:
         logging.error(f"Error retrieving stats: {e}")
         return "An error occurred while fetching the statistics.", 500
 
+# Run the query lazily, inside the streamed response's own context, and
+# yield its rows in fetchmany batches
+def iter_rows(sql, batch_size, args=()):
+    cursor = execute(sql, args)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield from rows
+
+# Like stream_template, but hands the server chunks of several template
+# events at a time instead of one tiny string per cell
+def stream_page(template_name, **context):
+    APP.update_template_context(context)
+    stream = APP.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(APP.config['STREAM_BUFFER_EVENTS'])
+    return APP.response_class(stream_with_context(stream))
+
+# HTML of the rows of /list (the key, then every column): the link of each
+# column is decided once per table from the schema and compiled into one
+# format string, so that a row costs a single str.format instead of a
+# template event per cell
+def row_renderer(table):
+    cells = [(i + 1, table.links.get(column)) for i, column in enumerate(table.columns)]
+    linked = ''.join(f'<td><a href="/list/{target}/{{{i}}}">{{{i}}}</a></td>' if target else f'<td>{{{i}}}</td>'
+                     for i, target in cells)
+    row_format = f'<tr>{linked}</tr>\n'
+
+    def render(row):
+        values = [escape(value) if isinstance(value, str) else value for value in row]
+        if None not in values:
+            return Markup(row_format.format(*values))
+        # No links to NULL references
+        return Markup(''.join(['<tr>'] + [
+            f'<td><a href="/list/{target}/{values[i]}">{values[i]}</a></td>' if target and values[i] is not None
+            else f'<td>{values[i]}</td>' for i, target in cells] + ['</tr>\n']))
+    return render
+
 # List table route
 @APP.route('/list/<table_name>/')
 def list_table(table_name):
-    allowed_tables = [row[0] for row in execute("SELECT name FROM sqlite_master WHERE type='table'")]
-    if table_name not in allowed_tables:
+    table = schema().get(table_name)
+    if table is None:
         return "Invalid table name", 400
-    query = f'SELECT * FROM {table_name}'
+    key = table.key
+    size = request.args.get('size', APP.config['LIST_PAGE_SIZE'], type=int)
+    size = min(max(size, 1), APP.config['LIST_MAX_PAGE_SIZE'])
+    after = request.args.get('after', type=int)
     try:
-        table_data = execute(query).fetchall()
+        # Full dump: stream the rows through the template in fetchmany batches
+        if request.args.get('all') == '1':
+            table_data = map(row_renderer(table), iter_rows(f'SELECT {key}, * FROM {table_name} ORDER BY {key}', size))
+            return stream_page('list_tables.html', table_name=table_name, columns=table.columns,
+                               table_data=table_data, size=size, next_after=None)
+        # One page, starting after the last key of the previous page
+        if after is None:
+            cursor = execute(f'SELECT {key}, * FROM {table_name} ORDER BY {key} LIMIT ?', (size + 1,))
+        else:
+            cursor = execute(f'SELECT {key}, * FROM {table_name} WHERE {key} > ? ORDER BY {key} LIMIT ?', (after, size + 1))
+        table_data = cursor.fetchall()
     except Exception as e:
         logging.error(f"Error retrieving table {table_name}: {e}")
         return "An error occurred while fetching the table.", 500
-    return render_template('list_tables.html', table_name=table_name, table_data=table_data)
-
+    next_after = table_data[size - 1][0] if len(table_data) > size else None
+    return render_template('list_tables.html', table_name=table_name, columns=table.columns,
+                           table_data=map(row_renderer(table), table_data[:size]), size=size, next_after=next_after)
+
+# Labels of the foreign keys of table that have one: {column: lookup} for the
+# small referenced tables, [column] for the ones to join
+def foreign_labels(tables, table):
+    lookups = {}
+    joined = []
+    for column, (ref_table, ref_column) in table.foreign_keys.items():
+        ref = tables.get(ref_table)
+        if ref is None or ref.label is None:
+            continue
+        lookup = LOOKUPS.get(ref_table, ref_column, ref.label, get_db, APP.config['LOOKUP_MAX_ROWS'])
+        if lookup is None:
+            joined.append(column)
+        else:
+            lookups[column] = lookup
+    return lookups, joined
+
+# (value, link, label) of every column of a row: foreign keys link to the
+# referenced record and carry its label
+def resolve_row(tables, table, row, lookups, labels=None):
+    cells = []
+    for column in table.columns:
+        value = row[column]
+        link = label = None
+        if column in table.foreign_keys and value is not None:
+            ref_table, ref_column = table.foreign_keys[column]
+            if ref_table in tables and tables[ref_table].key == ref_column:
+                link = url_for('dynamic_table_details', table_name=ref_table, id=value)
+            label = lookups[column].get(str(value)) if column in lookups else (labels or {}).get(column)
+        cells.append((value, link, label))
+    return cells
+
+# One page of the rows of child whose column references the record
+def child_page(tables, child, column, value, after):
+    size = APP.config['CHILD_PAGE_SIZE']
+    where = f'{column} = ?' + ('' if after is None else f' AND {child.key} > ?')
+    args = (value,) + (() if after is None else (after,))
+    rows = execute(f'SELECT {child.key}, * FROM {child.name} WHERE {where} ORDER BY {child.key} LIMIT ?',
+                   args + (size + 1,)).fetchall()
+    # Only the in-memory lookups: no query per child row
+    lookups, _ = foreign_labels(tables, child)
+    return {
+        'table_name': child.name,
+        'column': column,
+        'columns': child.columns,
+        'rows': [(url_for('dynamic_table_details', table_name=child.name, id=row[0]),
+                  resolve_row(tables, child, row, lookups)) for row in rows[:size]],
+        'next_after': rows[size - 1][0] if len(rows) > size else None,
+    }
+
+# A record with its foreign keys resolved and a page of each table
+# referencing it (?child=Inscricoes.CODEntidade&after=<key> pages through
+# one of them). Costs one query for the record and its large references,
+# plus one per referencing table; the small references are lookups.
 @APP.route('/list/<table_name>/<int:id>')
 def dynamic_table_details(table_name, id):
     try:
-        # Get the list of valid table names to validate the input
-        allowed_tables = [row[0] for row in execute("SELECT name FROM sqlite_master WHERE type='table'")]
-        if table_name not in allowed_tables:
+        tables = schema()
+        table = tables.get(table_name)
+        if table is None:
             return "Invalid table name", 400
 
-        # Get the primary key column for the specified table
-        pk_query = f"PRAGMA table_info({table_name})"
-        table_info = execute(pk_query).fetchall()
-        primary_key = None
-        for column in table_info:
-            if column['pk'] == 1:  # Check if this column is the primary key
-                primary_key = column['name']
-                break
-
-        if not primary_key:
-            return f"No primary key found for table {table_name}", 500
-
-        # Construct the query dynamically using the primary key
-        query = f"SELECT * FROM {table_name} WHERE {primary_key} = ?"
+        # Look the record up by its key column (the rowid for composite keys),
+        # joining the referenced tables too large to keep in memory
+        lookups, joined = foreign_labels(tables, table)
+        columns = ['T.*']
+        joins = []
+        for i, column in enumerate(joined):
+            ref_table, ref_column = table.foreign_keys[column]
+            columns.append(f'J{i}.{tables[ref_table].label} AS J{i}')
+            joins.append(f'LEFT JOIN {ref_table} J{i} ON J{i}.{ref_column} = T.{column}')
+        query = f"SELECT {', '.join(columns)} FROM {table_name} T {' '.join(joins)} WHERE T.{table.key} = ?"
         record = execute(query, (id,)).fetchone()
 
         # Handle the case where no record is found
         if not record:
-            return f"{table_name} with {primary_key} = {id} not found", 404
+            return f"{table_name} with {table.key} = {id} not found", 404
+
+        labels = {column: record[f'J{i}'] for i, column in enumerate(joined)}
+        fields = zip(table.columns, resolve_row(tables, table, record, lookups, labels))
+        paged = request.args.get('child')
+        after = request.args.get('after', type=int)
+        related = [child_page(tables, child, column, record[child.foreign_keys[column][1]],
+                              after if paged == f'{child.name}.{column}' else None)
+                   for child, column in children(tables, table)]
 
         # Render the record details
-        return render_template('dynamic_table.html', table_name=table_name, record=dict(record))
+        return render_template('dynamic_table.html', table_name=table_name, id=id, fields=fields,
+                               children=related)
 
     except Exception as e:
         logging.error(f"Error fetching record from {table_name}: {e}")
         return "An error occurred while fetching the record.", 500
 
+# Full-text search over the names of schools, entities, groupings and
+# courses (see search.py); ?autocomplete=1 returns a few suggestions as JSON
+@APP.route('/search')
+def search():
+    text = request.args.get('q', '')
+    table = request.args.get('table') or None
+    if table not in [None] + [name for name, _, _ in SEARCHED]:
+        return "Invalid table name", 400
+    query = match_query(text)
+    args = [query] + ([table] if table else [])
+    try:
+        if request.args.get('autocomplete') == '1':
+            return jsonify(autocomplete(query, table, args))
+        page = min(max(request.args.get('page', 1, type=int), 1), APP.config['SEARCH_MAX_PAGE'])
+        size = APP.config['SEARCH_PAGE_SIZE']
+        results = []
+        if query:
+            results = execute(search_sql(table), args + [size + 1, (page - 1) * size]).fetchall()
+        return render_template('search.html', q=text, table=table, tables=[name for name, _, _ in SEARCHED],
+                               results=results[:size], page=page, has_next=len(results) > size)
+    except Exception as e:
+        logging.error(f"Error searching for {text!r}: {e}")
+        return "An error occurred while searching.", 500
+
+# Best matches found within AUTOCOMPLETE_BUDGET_MS; none if it runs out
+def autocomplete(query, table, args):
+    if not query:
+        return []
+    deadline = time.monotonic() + APP.config['AUTOCOMPLETE_BUDGET_MS'] / 1000
+    try:
+        with statement_deadline(get_db(), deadline, steps=1000):
+            rows = execute(search_sql(table), args + [APP.config['AUTOCOMPLETE_SIZE'], 0]).fetchall()
+    except sqlite3.OperationalError as e:
+        if 'interrupted' not in str(e):
+            raise
+        # An empty list because the budget ran out is not the answer for
+        # this data version: no ETag, and nothing a cache may keep
+        g.pop('data_stamp', None)
+
+        @after_this_request
+        def no_store(response):
+            response.cache_control.no_store = True
+            return response
+        rows = []
+    return [{'Nome': row['Nome'], 'Tabela': row['Tabela'], 'Codigo': row['Codigo'],
+             'url': url_for('dynamic_table_details', table_name=row['Tabela'], id=row['Codigo'])}
+            for row in rows]
+
 #@APP.route('/queries')
 #def queries():
 #    return render_template('queries.html')
@@ -133,231 +539,348 @@ def dynamic_table_details(table_name, id):
 def tabelas():
     return render_template('tabelas.html')
 
+def report_rows(name, live=False, backend=None):
+    # Results precomputed by the refresher, unless a source was asked for
+    if not live and backend is None:
+        rows = REFRESHER.get(name)
+        if rows is not None:
+            return rows
+    return compute_report(name, live, backend)
+
+def compute_report(name, live=False, backend=None):
+    # Reports the columnar engine implements can be computed in memory; they
+    # show in /metrics as 'columnar: <report>', the others under their SQL
+    backend = backend or APP.config['REPORT_BACKEND']
+    if backend == 'columnar' and COLUMNAR and name in columnar.ENGINE_REPORTS:
+        engine = COLUMNAR.engine(get_db)
+        started = time.perf_counter()
+        rows = getattr(engine, name)()
+        QUERY_STATS.record(f'{columnar.FINGERPRINT}{name}', time.perf_counter() - started, len(rows))
+        return rows
+    # Serve a report from its summary table, falling back to live SQL
+    # when asked to or when the summaries have not been built yet
+    if not (live or APP.config['LIVE_REPORTS']):
+        try:
+            return execute(f'SELECT * FROM {summary_table(name)} ORDER BY rowid').fetchall()
+        except sqlite3.OperationalError as e:
+            logging.warning(f"Summary for {name} unavailable, using live SQL: {e}")
+    return execute(REPORTS[name]).fetchall()
+
+# Every report, recomputed in the background after each load (see
+# refresher.py); the caches are invalidated first when the data changed
+def derived_tasks():
+    return {name: functools.partial(compute_report, name) for name in REPORTS}
+
+REFRESHER = Refresher(lambda: (db_version() or [None])[0], derived_tasks, APP.app_context, invalidate_caches)
+
+# Worker threads running the reports side by side, each on its own pooled
+# connection (sqlite3 releases the GIL while a statement runs)
+REPORT_EXECUTOR = ThreadPoolExecutor(APP.config['REPORT_WORKERS'], thread_name_prefix='report')
+
+# Abort the statements run on conn after the deadline (a time.monotonic()
+# value) with sqlite3.OperationalError: interrupted
+@contextmanager
+def statement_deadline(conn, deadline, steps=10000):
+    # Called every steps SQLite VM steps; returning True aborts the statement
+    conn.set_progress_handler(lambda: time.monotonic() > deadline, steps)
+    try:
+        yield conn
+    finally:
+        conn.set_progress_handler(None, 0)
+
+# The deadline starts when a worker picks the report up: the workers are
+# shared by every request, and a report waiting behind the reports of other
+# requests has not used any of its time yet
+def run_report(name, live, backend, timeout):
+    deadline = time.monotonic() + timeout
+    with APP.app_context(), statement_deadline(get_db(), deadline):
+        return report_rows(name, live, backend)
+
+# Rows of every report by name; a report that fails or runs for longer than
+# REPORT_TIMEOUT gets no rows and is listed as unavailable
+def run_reports(names, live=False, backend=None):
+    # Reports precomputed by the refresher need no worker
+    results = {}
+    if not live and backend is None:
+        for name in names:
+            if REFRESHER.get(name) is not None:
+                results[name] = REFRESHER.get(name)
+    futures = {name: REPORT_EXECUTOR.submit(run_report, name, live, backend, APP.config['REPORT_TIMEOUT'])
+               for name in names if name not in results}
+    unavailable = []
+    for name, future in futures.items():
+        try:
+            # Bounded by the deadline of the report and of those ahead of it
+            results[name] = future.result()
+        except Exception as e:
+            future.cancel()
+            logging.error(f"Report {name} unavailable: {e}")
+            results[name] = []
+            unavailable.append(name)
+    return results, unavailable
+
 @APP.route('/queries')
 def queries():
     try:
+        reports, unavailable = run_reports([f'query{n}' for n in range(1, 13)], request.args.get('live') == '1',
+                                           request.args.get('backend'))
         stats = {}
-        stats['n_query1'] = [row['Curso'] for row in execute('SELECT Curso FROM Cursos').fetchall()]
+        stats['n_query1'] = [row['Curso'] for row in reports['query1']]
         stats['n_query2'] = [
             {'Curso': row['Curso'], 'NumeroMatriculas': row['NumeroMatriculas']}
-            for row in execute(
-                'SELECT Curso, COUNT(*) AS NumeroMatriculas '
-                'FROM Inscricoes I '
-                'JOIN Cursos C ON I.CODCurso = C.CODCurso '
-                'GROUP BY C.CODCurso'
-            ).fetchall()
+            for row in reports['query2']
         ]
         stats['n_query3'] = [
             {'Entidade': row['Entidade'], 'TotalAlunos': row['TotalAlunos']}
-            for row in execute(
-                'SELECT E.Entidade, SUM(I.NumeroAlunosMatriculados) AS TotalAlunos '
-                'FROM Inscricoes I '
-                'JOIN Entidade E ON I.CODEntidade = E.CODEntidade '
-                'GROUP BY E.CODEntidade '
-                'ORDER BY TotalAlunos DESC'
-            ).fetchall()
+            for row in reports['query3']
         ]
         stats['n_query4'] = [
             {'CODEntidade': row['CODEntidade'], 'Escola': row['Escola'], 'TotalAlunos': row['TotalAlunos']}
-            for row in execute(
-                'SELECT DISTINCT I.CODEntidade, Es.Escola, SUM(I.NumeroAlunosMatriculados) AS TotalAlunos '
-                'FROM Inscricoes I '
-                'JOIN Entidade E ON E.CODEntidade = I.CODEntidade '
-                'JOIN Escola Es ON E.CODEscola = Es.CODEscola '
-                'GROUP BY I.CODEntidade '
-                'HAVING E.Natureza LIKE "%privado%"'
-            ).fetchall()
+            for row in reports['query4']
         ]
         stats['n_query5'] = [
             {'Distrito': row['distrito'], 'TotalPrivadas': row['total_privadas'], 'TotalPublicas': row['total_publicas']}
-            for row in execute(
-                'SELECT D.distrito, '
-                'count(CASE WHEN E.Natureza LIKE "%Privado%" THEN E.CODEscola END) AS total_privadas, '
-                'count(CASE WHEN E.Natureza LIKE "%Público%" THEN E.CODEscola END) AS total_publicas '
-                'FROM Distrito D '
-                'JOIN Concelho C ON D.CODDistrito = C.CODDistrito '
-                'JOIN Localizacao L ON L.CODConcelho = C.CODConcelho '
-                'JOIN Entidade E ON L.CODEntidade = E.CODEntidade '
-                'GROUP BY D.distrito'
-            ).fetchall()
+            for row in reports['query5']
         ]
         stats['n_query6'] = [
             {'Concelho': row['Concelho'], 'MaxAlunos': row['MAX(TotalAlunos)']}
-            for row in execute(
-                'WITH nrinscritosconcelho AS ('
-                'SELECT C.Concelho, SUM(NumeroAlunosMatriculados) AS TotalAlunos '
-                'FROM Localizacao L '
-                'JOIN Inscricoes I ON L.CODEntidade = I.CODEntidade '
-                'JOIN Concelho C ON L.CODConcelho = C.CODConcelho '
-                'GROUP BY L.CODConcelho) '
-                'SELECT Concelho, MAX(TotalAlunos) FROM nrinscritosconcelho'
-            ).fetchall()
+            for row in reports['query6']
         ]
         stats['n_query7'] = [
             {'NUTSII': row['NUTSII'], 'TotalEscolas': row['total_escolas']}
-            for row in execute(
-                'SELECT COUNT(E.CODEscola) AS total_escolas, NII.NUTSII '
-                'FROM Entidade E '
-                'JOIN Localizacao L ON L.CODEntidade = E.CODEntidade '
-                'JOIN Concelho C ON L.CODConcelho = C.CODConcelho '
-                'JOIN NUTSIII NIII ON C.CODNUTSIII = NIII.CODNUTSIII '
-                'JOIN NUTSII NII ON NIII.CODNUTSII = NII.CODNUTSII '
-                'GROUP BY NII.NUTSII '
-                'ORDER BY total_escolas DESC'
-            ).fetchall()
+            for row in reports['query7']
         ]
         stats['n_query8'] = [
             {'NivelEnsino': row['NivelEnsino'], 'TotalAlunos': row['TotalAlunos']}
-            for row in execute(
-                'SELECT N.NivelEnsino, SUM(NumeroAlunosMatriculados) AS TotalAlunos '
-                'FROM Inscricoes I '
-                'JOIN Nivelensino N ON I.CODNivelEnsino = N.CODNivelEnsino '
-                'GROUP BY N.CODNivelEnsino'
-            ).fetchall()
+            for row in reports['query8']
         ]
         stats['n_query9'] = [
             {'Concelho': row['Concelho'], 'Sexo': row['Sexo'], 'TotalAlunos': row['TotalAlunos']}
-            for row in execute(
-                'SELECT C.Concelho, S.Sexo, SUM(NumeroAlunosMatriculados) AS TotalAlunos '
-                'FROM Localizacao L '
-                'JOIN Inscricoes I ON L.CODEntidade = I.CODEntidade '
-                'JOIN Sexo S ON I.CODSexo = S.CODSexo '
-                'JOIN Concelho C ON L.CODConcelho = C.CODConcelho '
-                'GROUP BY L.CODConcelho, S.CODSexo'
-            ).fetchall()
+            for row in reports['query9']
         ]
         stats['n_query10'] = [
             {'Distrito': row['Distrito'], 'Natureza': row['Natureza'], 'PCTPublico': row['PCTPublico']}
-            for row in execute(
-                'WITH NrAlunos AS ('
-                'SELECT D.CODDistrito, SUM(I.NumeroAlunosMatriculados) AS NumeroAlunosMatriculados '
-                'FROM Inscricoes I '
-                'JOIN Entidade E ON I.CODEntidade = E.CODEntidade '
-                'JOIN Concelho C ON L.CODConcelho = C.CODConcelho '
-                'JOIN Distrito D ON C.CODDistrito = D.CODDistrito '
-                'JOIN Localizacao L ON E.CODEntidade = L.CODEntidade '
-                'GROUP BY D.CODDistrito) '
-                'SELECT D.Distrito, E.Natureza, 100 * SUM(I.NumeroAlunosMatriculados) / NA.NumeroAlunosMatriculados as PCTPublico '
-                'FROM Inscricoes I '
-                'JOIN Entidade E ON I.CODEntidade = E.CODEntidade '
-                'JOIN Concelho C ON L.CODConcelho = C.CODConcelho '
-                'JOIN Distrito D ON C.CODDistrito = D.CODDistrito '
-                'JOIN Localizacao L ON E.CODEntidade = L.CODEntidade '
-                'JOIN NrAlunos NA ON D.CODDistrito = NA.CODDistrito '
-                'WHERE E.Natureza LIKE "%Público%" '
-                'GROUP BY D.CODDistrito, E.Natureza '
-                'ORDER BY D.CODDistrito, E.Natureza'
-            ).fetchall()
+            for row in reports['query10']
         ]
         stats['n_query11'] = [
             {'Curso': row['curso'], 'Diferenca': row['diferenca']}
-            for row in execute(
-                'WITH alunos_por_sexo AS ('
-                'SELECT C.curso, '
-                'sum(CASE WHEN S.Sexo = "Homens" THEN I.NumeroAlunosMatriculados ELSE 0 END) AS total_masculino, '
-                'sum(CASE WHEN S.Sexo = "Mulheres" THEN I.NumeroAlunosMatriculados ELSE 0 END) AS total_feminino '
-                'FROM inscricoes I '
-                'JOIN Cursos C ON I.CODCurso = C.CODCurso '
-                'JOIN Sexo S ON I.CODSexo = S.CODSexo '
-                'GROUP BY C.Curso), '
-                'diferencas AS ('
-                'SELECT curso, abs(total_masculino - total_feminino) AS diferenca '
-                'FROM alunos_por_sexo) '
-                'SELECT curso, diferenca '
-                'FROM diferencas '
-                'WHERE diferenca = (SELECT max(diferenca) FROM diferencas)'
-            ).fetchall()
+            for row in reports['query11']
         ]
         stats['n_query12'] = [
             {'Concelho': row['Concelho'], 'Entidade': row['Entidade'], 'MaxAlunos': row['MAXAlunos']}
-            for row in execute(
-                'WITH NrAlunosEntidade AS ('
-                'SELECT C.concelho, E.entidade, SUM(I.NumeroAlunosMatriculados) AS nr_alunos '
-                'FROM Inscricoes I '
-                'JOIN Entidade E ON I.CODEntidade = E.CODEntidade '
-                'JOIN Localizacao L ON E.CODEntidade = L.CODEntidade '
-                'JOIN Concelho C ON L.CODConcelho = C.CODConcelho '
-                'GROUP BY C.CODConcelho, I.CODEntidade) '
-                'SELECT Concelho, Entidade, MAX(nr_alunos) as MAXAlunos '
-                'FROM NrAlunosEntidade '
-                'GROUP BY Concelho '
-                'ORDER BY MAXAlunos DESC'
-            ).fetchall()
+            for row in reports['query12']
         ]
-        
-        logging.info(stats)
-        return render_template('queries.html', stats=stats)
+
+        # A partial page must not be cached as the page of this data version
+        if unavailable:
+            g.pop('data_stamp', None)
+        return render_template('queries.html', stats=stats, unavailable=unavailable)
 
     except Exception as e:
         logging.error(f"Error retrieving stats: {e}")
         return "An error occurred while fetching the statistics.", 500
 
-@APP.route('/data')
-def get_data():
-
-    # Connect to the database
-    db = sqlite3.connect("AlunosMatriculados.db")
-    cursor = db.cursor()
-
-    # Execute the query
-    query = """
-    SELECT N.NivelEnsino, SUM(NumeroAlunosMatriculados) AS TotalAlunos
-    FROM Inscricoes I
-    JOIN Nivelensino N ON I.CODNivelEnsino = N.CODNivelEnsino
-    GROUP BY N.CODNivelEnsino
-    """
-    cursor.execute(query)
-    results = cursor.fetchall()
+# Datasets of the homepage charts: report and the keys of its two columns
+CHARTS = {
+    'niveis': ['NivelEnsino', 'TotalAlunos'],
+    'sexo': ['Sexo', 'TotalAlunos'],
+    'natureza': ['Natureza', 'TotalEntidades'],
+}
 
-    print(results)
+def chart_data(name, live=False, backend=None):
+    label, value = CHARTS[name]
+    return [{label: row[0], value: row[1]} for row in report_rows(name, live, backend)]
 
-    data = [{'NivelEnsino': row[0], 'TotalAlunos': row[1]} for row in results]
-    db.close()
-    return jsonify(data)
+@APP.route('/data')
+def get_data():
+    return jsonify(chart_data('niveis', request.args.get('live') == '1', request.args.get('backend')))
 
 @APP.route('/sexo')
 def get_sexo():
-
-    # Connect to the database
-    db = sqlite3.connect("AlunosMatriculados.db")
-    cursor = db.cursor()
-
-    # Execute the query
-    query = """
-    select sexo.sexo, sum(inscricoes.NumeroAlunosMatriculados) as total_inscritos from sexo
-    join inscricoes on inscricoes.codsexo = sexo.codsexo
-    group by sexo.codsexo
-    """
-    cursor.execute(query)
-    results = cursor.fetchall()
-
-    print(results)
-
-    data = [{'Sexo': row[0], 'TotalAlunos': row[1]} for row in results]
-    db.close()
-    return jsonify(data)
+    return jsonify(chart_data('sexo', request.args.get('live') == '1', request.args.get('backend')))
 
 @APP.route('/natureza')
 def get_natureza():
+    return jsonify(chart_data('natureza', request.args.get('live') == '1', request.args.get('backend')))
+
+# Several chart datasets in one response, e.g. /api/charts?names=sexo,natureza
+# (every dataset when names is left out), all read on the request's pooled
+# connection or from the refresher's results
+@APP.route('/api/charts')
+def api_charts():
+    names = [name for name in request.args.get('names', ','.join(CHARTS)).split(',') if name]
+    unknown = [name for name in names if name not in CHARTS]
+    if unknown:
+        return jsonify(error=f"Unknown chart: {', '.join(unknown)}"), 400
+    try:
+        return jsonify({name: chart_data(name, request.args.get('live') == '1', request.args.get('backend'))
+                        for name in names})
+    except Exception as e:
+        logging.error(f"Error retrieving charts {names}: {e}")
+        return jsonify(error='An error occurred while fetching the charts.'), 500
+
+# Enrollments grouped by any of the dimensions in aggregate.py, e.g.
+# /api/aggregate?dims=distrito,sexo&measure=alunos&nivelensino=2,3
+# Every other argument filters a dimension by its codes.
+@APP.route('/api/aggregate')
+def api_aggregate():
+    dims = [dim for dim in request.args.get('dims', '').lower().split(',') if dim]
+    measure = request.args.get('measure', 'alunos')
+    filters = {}
+    for name, value in request.args.items(multi=True):
+        if name not in ('dims', 'measure'):
+            filters.setdefault(name.lower(), []).extend(code for code in value.split(',') if code)
+    try:
+        key = normalize_request(dims, filters, measure)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
 
-    # Connect to the database
-    db = sqlite3.connect("AlunosMatriculados.db")
-    cursor = db.cursor()
-
-    # Execute the query
-    query = """
-    select entidade.Natureza, count(entidade.CODEntidade) as TotalEntidades from entidade
-    group by entidade.natureza
-    """
-    cursor.execute(query)
-    results = cursor.fetchall()
-
-    print(results)
+    def compute():
+        sql, args = compile_query(*key)
+        return [dict(row) for row in execute(sql, args).fetchall()]
 
-    data = [{'Natureza': row[0], 'TotalEntidades': row[1]} for row in results]
-    db.close()
-    return jsonify(data)
+    try:
+        return jsonify(AGGREGATE_CACHE.get(key, compute))
+    except Exception as e:
+        logging.error(f"Error aggregating {key}: {e}")
+        return jsonify(error='An error occurred while aggregating.'), 500
+
+# Roll-up and drill-down over the precomputed cube (see cube.py), e.g.
+# /api/cube?level=concelho&distrito=5&sexo=* : every concelho of distrito 5,
+# split by sex. sexo, nivelensino and natureza take a code; '*' asks for
+# every value and leaving them out gives the total.
+@APP.route('/api/cube')
+def api_cube():
+    level = request.args.get('level', 'distrito').lower()
+    if level not in LEVELS:
+        return jsonify(error=f'Unknown level: {level}'), 400
+    attributes = {}
+    for name, column in (('sexo', 'CODSexo'), ('nivelensino', 'CODNivelEnsino'), ('natureza', 'CODNatureza')):
+        value = request.args.get(name)
+        if value is not None and value != '*':
+            value = request.args.get(name, type=int)
+            if value is None:
+                return jsonify(error=f'{name} takes a code or *'), 400
+        attributes[column] = value
+    ancestors = {}
+    for ancestor in LEVELS:
+        if ancestor in request.args:
+            ancestors[ancestor] = request.args.get(ancestor, type=int)
+            if ancestors[ancestor] is None:
+                return jsonify(error=f'{ancestor} takes a code'), 400
+    try:
+        sql, args = cube_query(level, attributes, ancestors)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    try:
+        return jsonify([dict(row) for row in execute(sql, args).fetchall()])
+    except Exception as e:
+        logging.error(f"Error reading the cube: {e}")
+        return jsonify(error='An error occurred while reading the cube.'), 500
+
+# Stream the rows of source (a table or subquery) as the requested format,
+# one chunk per batch, without a Content-Length (chunked transfer)
+def export_response(name, source, available, order_by=None):
+    fmt = request.args.get('format', 'csv')
+    if fmt not in FORMATS:
+        return f"Invalid format, use one of: {', '.join(FORMATS)}", 400
+    try:
+        columns, filters = parse_request(request.args, available)
+    except ValueError as e:
+        return str(e), 400
+    sql, args = export_sql(source, columns, filters, order_by)
+    writer, content_type, extension = FORMATS[fmt]
+
+    def generate():
+        try:
+            size = APP.config['EXPORT_BATCH_SIZE']
+            rows = iter_rows(sql, size, args)
+            # The writers take the rows in batches of size
+            yield from writer(columns, iter(lambda: list(itertools.islice(rows, size)), []))
+        except Exception as e:
+            # Too late for an error status: the client gets a truncated file
+            logging.error(f"Error exporting {name}: {e}")
+            raise
+
+    response = APP.response_class(stream_with_context(generate()), content_type=content_type)
+    response.headers['Content-Disposition'] = f'attachment; filename={name}.{extension}'
+    return response
+
+# Bulk export of a table, e.g. /export/Inscricoes?format=ndjson&CODSexo=1
+# &columns=CODEntidade,NumeroAlunosMatriculados (format: csv, ndjson or, with
+# pyarrow installed, parquet)
+@APP.route('/export/<table_name>')
+def export_table(table_name):
+    table = schema().get(table_name)
+    if table is None:
+        return "Invalid table name", 400
+    return export_response(table_name, table_name, table.columns, table.key)
+
+# Bulk export of a report of reports.py, from its summary table when built
+@APP.route('/export/query/<report>')
+def export_report(report):
+    if report not in REPORTS:
+        return "Invalid report name", 400
+    summary = schema().get(summary_table(report))
+    if summary is not None and not APP.config['LIVE_REPORTS']:
+        return export_response(report, summary.name, summary.columns, 'rowid')
+    source = f'({REPORTS[report]})'
+    try:
+        columns = [column[0] for column in execute(f'SELECT * FROM {source} LIMIT 0').description]
+    except Exception as e:
+        logging.error(f"Error exporting {report}: {e}")
+        return "An error occurred while exporting the report.", 500
+    return export_response(report, source, columns)
+
+# Pre-render the pages of snapshots.SNAPSHOT_URLS from the current data:
+# flask --app app export-snapshots (also run by create_db.py after a load)
+def export_snapshots():
+    version = db_version()
+    if version is None:
+        raise SystemExit(f"Database {APP.config['DATABASE']} not found")
+    manifest = SNAPSHOTS.export(APP.test_client(), version[0], APP.config['GZIP_LEVEL'])
+    logging.info('Exported {} snapshots to {}'.format(len(manifest['urls']), SNAPSHOTS.directory))
+
+@APP.cli.command('export-snapshots')
+def export_snapshots_command():
+    export_snapshots()
+
+# Load everything the first requests would otherwise pay for: the schema,
+# every report (a refresh, which also builds the columnar engine when it is
+# the backend), the index statistics and the database file itself into the
+# OS page cache. Runs on the calling thread only, so that it can run in a
+# master process before fork.
+def warm_up():
+    started = time.monotonic()
+    REFRESHER.refresh()
+    with APP.app_context():
+        schema()
+        index_stats()
+    with open(APP.config['DATABASE'], 'rb') as f:
+        while f.read(1 << 20):
+            pass
+    logging.info('Warm-up done in {:.2f}s'.format(time.monotonic() - started))
+
+# State of the background refresher: data version of the results served,
+# number of refreshes and how long the last one took, per report
+@APP.route('/refresh')
+def refresh_status():
+    return jsonify(REFRESHER.status())
+
+# Aggregated statement timings, slowest in total first
+@APP.route('/metrics')
+def metrics():
+    return jsonify(QUERY_STATS.snapshot())
 
 # Main server start-up
 if __name__ == '__main__':
-    APP.run(host='0.0.0.0', port=9001)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, _reload_signal)
+    with open(PID_FILE, 'w') as f:
+        f.write(str(os.getpid()))
+    warm_up()
+    REFRESHER.start(APP.config['REFRESH_INTERVAL'])
+    try:
+        APP.run(host='0.0.0.0', port=9001)
+    finally:
+        os.remove(PID_FILE)
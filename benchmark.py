@@ -0,0 +1,250 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import create_db
+from cube import build_cube
+from reports import refresh_summaries
+from search import build_search_index
+
+# Synthetic enrollment source, in the layout of the DGEEC sheet read by create_db.py.
+# The size is given by base_rows * scale; entities, courses and places grow with it.
+ROWS_PER_ENTITY = 30
+NUTSII = ["Norte", "Centro", "Área Metropolitana de Lisboa", "Alentejo", "Algarve"]
+NATUREZAS = [("Público", "Pública"), ("Privado dependente do Estado", "Privada"),
+             ("Privado independente", "Privada")]
+SEXOS = ["Homens", "Mulheres"]
+
+
+def synthetic_chunks(rows, chunk_size, seed=2017):
+    rng = np.random.default_rng(seed)
+    n_entities = max(rows // ROWS_PER_ENTITY, 1)
+    n_concelhos = min(max(n_entities // 10, 10), 278)
+    n_cursos = min(max(rows // 500, 20), 400)
+    entities_per_chunk = max(chunk_size // ROWS_PER_ENTITY, 1)
+    # Attributes fixed per entity, so every chunk agrees on them
+    concelho_of = rng.integers(0, n_concelhos, n_entities)
+    natureza_of = rng.integers(0, len(NATUREZAS), n_entities)
+    for first in range(0, n_entities, entities_per_chunk):
+        entities = np.arange(first, min(first + entities_per_chunk, n_entities))
+        entity = np.repeat(entities, ROWS_PER_ENTITY)
+        n = len(entity)
+        concelho = concelho_of[entity]
+        nutsiii = concelho % 23
+        natureza = natureza_of[entity]
+        code = entity + 100000
+        yield pd.DataFrame({
+            "ANO LETIVO": "2017/2018",
+            "NUTS II (2013)": np.array(NUTSII)[nutsiii % len(NUTSII)],
+            "NUTS III (2013)": np.char.add("NUTS III ", nutsiii.astype(str)),
+            "DISTRITO": np.char.add("Distrito ", (concelho % 18).astype(str)),
+            "CONCELHO": np.char.add("Concelho ", concelho.astype(str)),
+            "CÓDICO DGEEC ENTIDADE": code,
+            "ENTIDADE": np.char.add("Entidade ", code.astype(str)),
+            "CÓDIGO DGEEC ESCOLA": code,
+            "ESCOLA": np.char.add("Escola ", code.astype(str)),
+            "CÓDIGO DGEEC AGRUPAMENTO": code // 5,
+            "AGRUPAMENTO": np.char.add("Agrupamento ", (code // 5).astype(str)),
+            "CÓDIGO DGEEC ESCOLA SEDE": code // 5,
+            "ESCOLA SEDE": np.char.add("Escola Sede ", (code // 5).astype(str)),
+            "REDE": np.array([rede for _, rede in NATUREZAS])[natureza],
+            "NATUREZA": np.array([nome for nome, _ in NATUREZAS])[natureza],
+            "TIPOLOGIA": np.where(entity % 3 == 0, "AE", "ENA"),
+            "OFERTA": np.char.add("Oferta ", rng.integers(0, 6, n).astype(str)),
+            "NÍVEL DE  ENSINO": np.char.add("Nível ", rng.integers(0, 5, n).astype(str)),
+            "ORGANIZAÇÃO": np.char.add("Organização ", rng.integers(0, 3, n).astype(str)),
+            "CICLO DE ESTUDOS": np.char.add("Ciclo ", rng.integers(0, 4, n).astype(str)),
+            "CURSO": np.char.add("Curso ", rng.integers(0, n_cursos, n).astype(str)),
+            "SEXO": np.array(SEXOS)[rng.integers(0, 2, n)],
+            "ORIENTAÇÃO": np.char.add("Orientação ", rng.integers(0, 3, n).astype(str)),
+            "ANO DE ESCOLARIDADE": np.char.add("Ano ", rng.integers(1, 13, n).astype(str)),
+            "NÚMERO DE ALUNOS MATRICULADOS": rng.integers(1, 120, n),
+        })
+
+
+def build_database(path, rows, chunk_size):
+    # Same steps as create_db.py: tables, chunked load, indexes, summaries, cube and search index
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.executescript(create_db.create_tables_sql)
+    create_db.fill_db(conn, synthetic_chunks(rows, chunk_size))
+    create_db.create_indexes(conn)
+    refresh_summaries(conn)
+    build_cube(conn)
+    build_search_index(conn)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    count = conn.execute("SELECT COUNT(*) FROM Inscricoes").fetchone()[0]
+    conn.close()
+    return count
+
+
+# Build the database in a child process, so that the memory used by the
+# loader does not count against the routes measured in this one
+def generate_database(path, rows, chunk_size):
+    process = multiprocessing.get_context('spawn').Process(target=build_database, args=(path, rows, chunk_size))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f'Generating {path} failed with exit code {process.exitcode}')
+
+
+def use_database(app, path):
+    app.APP.config['DATABASE'] = path
+    app.POOL.path = path
+    app.invalidate_caches()
+    # The templates may sit next to app.py instead of in templates/
+    if not os.path.isdir(os.path.join(app.APP.root_path, app.APP.template_folder)):
+        app.APP.template_folder = app.APP.root_path
+
+
+def route_paths(path, rng):
+    conn = sqlite3.connect(path)
+    entities = [row[0] for row in conn.execute("SELECT CODEntidade FROM Entidade")]
+    n_inscricoes = conn.execute("SELECT MAX(rowid) FROM Inscricoes").fetchone()[0]
+    conn.close()
+    return {
+        '/': lambda: '/',
+        '/queries': lambda: '/queries',
+        '/queries?live=1': lambda: '/queries?live=1',
+        '/list/Inscricoes/': lambda: '/list/Inscricoes/',
+        '/list/Inscricoes/?after=<k>': lambda: f'/list/Inscricoes/?after={rng.randint(1, n_inscricoes)}',
+        '/list/Entidade/<id>': lambda: f'/list/Entidade/{rng.choice(entities)}',
+        '/list/Inscricoes/<id>': lambda: f'/list/Inscricoes/{rng.randint(1, n_inscricoes)}',
+        '/data': lambda: '/data',
+        '/sexo': lambda: '/sexo',
+        '/natureza': lambda: '/natureza',
+        '/api/charts': lambda: '/api/charts',
+        '/api/cube?level=concelho&sexo=*': lambda: '/api/cube?level=concelho&sexo=*',
+        '/search?q=<prefix>&autocomplete=1': lambda: f'/search?q=Escola+{rng.randint(10, 99)}&autocomplete=1',
+    }
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * p / 100), len(samples) - 1)]
+
+
+# Peak of the Python allocations made while serving a few requests one at a
+# time, traced apart from the timed run (tracemalloc slows every allocation;
+# memory allocated by SQLite itself is not traced)
+def peak_alloc(app, make_path, samples=3):
+    client = app.APP.test_client()
+    peak = 0
+    tracemalloc.start()
+    try:
+        for _ in range(samples):
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            client.get(make_path()).get_data()
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def run_route(app, make_path, requests, concurrency):
+    def worker(count):
+        client = app.APP.test_client()
+        latencies = []
+        for _ in range(count):
+            path = make_path()
+            start = time.perf_counter()
+            response = client.get(path)
+            response.get_data()
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                raise RuntimeError(f'{path} returned {response.status_code}')
+        return latencies
+
+    counts = [requests // concurrency + (1 if i < requests % concurrency else 0) for i in range(concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        latencies = [latency for result in executor.map(worker, counts) for latency in result]
+    elapsed = time.perf_counter() - start
+    return {
+        'requests': len(latencies),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'throughput_rps': len(latencies) / elapsed,
+        'peak_alloc_mb': peak_alloc(app, make_path) / 2**20,
+    }
+
+
+def print_results(scale, rows, results):
+    print(f'\nScale {scale}x ({rows} Inscricoes rows)')
+    print(f"{'route':32} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>9} {'alloc MB':>9}")
+    for route, r in results.items():
+        print(f"{route:32} {r['p50_ms']:9.2f} {r['p95_ms']:9.2f} {r['p99_ms']:9.2f} "
+              f"{r['throughput_rps']:9.1f} {r['peak_alloc_mb']:9.2f}")
+
+
+# Routes whose p95 grew more than tolerance over the baseline run
+def regressions(report, baseline, tolerance):
+    found = []
+    for scale, run in report.items():
+        for route, r in run['routes'].items():
+            before = baseline.get(scale, {}).get('routes', {}).get(route)
+            if before and r['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+                found.append(f"{scale}x {route}: p95 {before['p95_ms']:.2f} -> {r['p95_ms']:.2f} ms")
+    return found
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Latency benchmark of every route on synthetic databases')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100],
+                        help='multiples of --base-rows to generate (default: 1 10 100)')
+    parser.add_argument('--base-rows', type=int, default=20000, help='Inscricoes rows at scale 1')
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--concurrency', type=int, default=4, help='concurrent client threads')
+    parser.add_argument('--workdir', help='where to keep the generated databases (default: a temporary directory)')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results of a previous run; exit with 1 on p95 regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed p95 growth over the baseline')
+    args = parser.parse_args()
+
+    import app
+
+    logging.getLogger().setLevel(logging.WARNING)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='alunos-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    rng = random.Random(2017)
+    report = {}
+    for scale in args.scales:
+        path = os.path.join(workdir, f'AlunosMatriculados_{scale}x.db')
+        if not os.path.exists(path):
+            print(f'Generating {path}...', file=sys.stderr)
+            generate_database(path, args.base_rows * scale, chunk_size=50000)
+        rows = sqlite3.connect(path).execute("SELECT COUNT(*) FROM Inscricoes").fetchone()[0]
+        use_database(app, path)
+        results = {}
+        for route, make_path in route_paths(path, rng).items():
+            results[route] = run_route(app, make_path, args.requests, args.concurrency)
+        print_results(scale, rows, results)
+        report[str(scale)] = {'rows': rows, 'routes': results}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(report, json.load(f), args.tolerance)
+        for line in found:
+            print('REGRESSION', line)
+        sys.exit(1 if found else 0)
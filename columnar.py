@@ -0,0 +1,250 @@
+import argparse
+import logging
+import sqlite3
+import threading
+
+import numpy as np
+
+from reports import REPORTS
+
+db_path = "AlunosMatriculados.db"
+
+# Integer key columns of Inscricoes kept in memory, plus the measure
+FACT_COLUMNS = ['CODAnoLetivo', 'CODEntidade', 'CODOrganizacao', 'CODAnoEscolaridade', 'CODNivelEnsino',
+                'CODOferta', 'CODCurso', 'CODOrientacao', 'CODCicloEstudos', 'CODSexo',
+                'NumeroAlunosMatriculados']
+
+# Dimension tables: name column of each, loaded into arrays indexed by code
+DIMENSIONS = {
+    'Cursos': ('CODCurso', 'Curso'),
+    'Entidade': ('CODEntidade', 'Entidade'),
+    'NivelEnsino': ('CODNivelEnsino', 'NivelEnsino'),
+    'Sexo': ('CODSexo', 'Sexo'),
+    'Concelho': ('CODConcelho', 'Concelho'),
+}
+
+BATCH_SIZE = 100000
+
+
+# Result row indexable by position or, like sqlite3.Row, by column name
+# regardless of case
+class Row(tuple):
+    columns = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            key = self._index[key.lower()]
+        return tuple.__getitem__(self, key)
+
+    def keys(self):
+        return list(self.columns)
+
+
+def row_type(*columns):
+    return type('Row', (Row,), {'columns': columns, '_index': {c.lower(): i for i, c in enumerate(columns)}})
+
+
+def lookup(conn, table, code, name):
+    # Names by code: names[code] is the name, None where there is no member
+    rows = conn.execute(f'SELECT {code}, {name} FROM {table}').fetchall()
+    names = np.full(max((row[0] for row in rows), default=-1) + 1, None, dtype=object)
+    for key, value in rows:
+        names[key] = value
+    return names
+
+
+# Inscricoes as one NumPy array per column, with the dimension names and the
+# entity -> concelho mapping needed by the reports. Each report is a few
+# vectorized group-by kernels (bincount over the integer codes).
+class ColumnarEngine:
+    def __init__(self, conn):
+        batches = []
+        cursor = conn.execute(f"SELECT {', '.join(f'CAST({c} AS INTEGER)' for c in FACT_COLUMNS)} "
+                              'FROM Inscricoes ORDER BY rowid')
+        while True:
+            rows = cursor.fetchmany(BATCH_SIZE)
+            if not rows:
+                break
+            batches.append(np.array(rows, dtype=np.int64).reshape(-1, len(FACT_COLUMNS)))
+        data = np.concatenate(batches) if batches else np.empty((0, len(FACT_COLUMNS)), dtype=np.int64)
+        self.columns = {column: np.ascontiguousarray(data[:, i], dtype=np.int32)
+                        for i, column in enumerate(FACT_COLUMNS)}
+        self.names = {table: lookup(conn, table, code, name) for table, (code, name) in DIMENSIONS.items()}
+        locations = conn.execute('SELECT CODEntidade, CODConcelho FROM Localizacao').fetchall()
+        self.concelho_of = np.full(len(self.names['Entidade']), -1, dtype=np.int32)
+        for entity, concelho in locations:
+            if entity < len(self.concelho_of):
+                self.concelho_of[entity] = concelho
+        self.naturezas = conn.execute('SELECT N.Natureza FROM Entidade E '
+                                      'LEFT JOIN Natureza N ON N.CODNatureza = E.CODNatureza').fetchall()
+        logging.info('Loaded {} Inscricoes rows into the columnar engine'.format(len(data)))
+
+    def _totals(self, codes, table, weights=None):
+        # Sum (or count) per code of a dimension; only codes present both in
+        # the facts and in the dimension, as an inner join would keep
+        names = self.names[table]
+        mask = (codes >= 0) & (codes < len(names))
+        totals = np.bincount(codes[mask], weights=None if weights is None else weights[mask],
+                             minlength=len(names))
+        present = np.bincount(codes[mask], minlength=len(names)) > 0
+        keys = np.flatnonzero(present & np.not_equal(names, None))
+        return keys, totals[keys].astype(np.int64)
+
+    def _alunos(self):
+        return self.columns['NumeroAlunosMatriculados'].astype(np.float64)
+
+    def query1(self):
+        row = row_type('Curso')
+        names = self.names['Cursos']
+        return [row((names[code],)) for code in np.flatnonzero(np.not_equal(names, None))]
+
+    def query2(self):
+        row = row_type('Curso', 'NumeroMatriculas')
+        keys, counts = self._totals(self.columns['CODCurso'], 'Cursos')
+        return [row((self.names['Cursos'][k], int(n))) for k, n in zip(keys, counts)]
+
+    def query3(self):
+        row = row_type('Entidade', 'TotalAlunos')
+        keys, totals = self._totals(self.columns['CODEntidade'], 'Entidade', self._alunos())
+        order = np.argsort(-totals, kind='stable')
+        return [row((self.names['Entidade'][keys[i]], int(totals[i]))) for i in order]
+
+    def _concelhos(self):
+        # Concelho of every row through Localizacao, -1 where there is none
+        entities = self.columns['CODEntidade']
+        inside = (entities >= 0) & (entities < len(self.concelho_of))
+        return np.where(inside, self.concelho_of[np.where(inside, entities, 0)], -1)
+
+    def query6(self):
+        row = row_type('Concelho', 'MAX(TotalAlunos)')
+        keys, totals = self._totals(self._concelhos(), 'Concelho', self._alunos())
+        if not len(keys):
+            return [row((None, None))]
+        best = int(np.argmax(totals))
+        return [row((self.names['Concelho'][keys[best]], int(totals[best])))]
+
+    def query8(self):
+        row = row_type('NivelEnsino', 'TotalAlunos')
+        keys, totals = self._totals(self.columns['CODNivelEnsino'], 'NivelEnsino', self._alunos())
+        return [row((self.names['NivelEnsino'][k], int(t))) for k, t in zip(keys, totals)]
+
+    def query9(self):
+        row = row_type('Concelho', 'Sexo', 'TotalAlunos')
+        concelhos = self._concelhos()
+        sexes = self.columns['CODSexo']
+        n_sexes = len(self.names['Sexo'])
+        valid = (concelhos >= 0) & (sexes >= 0) & (sexes < n_sexes)
+        # One bincount over the combined (concelho, sexo) key
+        combined = concelhos[valid].astype(np.int64) * n_sexes + sexes[valid]
+        weights = self._alunos()[valid]
+        totals = np.bincount(combined, weights=weights)
+        present = np.bincount(combined) > 0
+        result = []
+        for key in np.flatnonzero(present):
+            concelho, sexo = divmod(int(key), n_sexes)
+            if concelho < len(self.names['Concelho']) and self.names['Concelho'][concelho] is not None \
+                    and self.names['Sexo'][sexo] is not None:
+                result.append(row((self.names['Concelho'][concelho], self.names['Sexo'][sexo], int(totals[key]))))
+        return result
+
+    def query11(self):
+        row = row_type('curso', 'diferenca')
+        names = self.names['Sexo']
+        alunos = self._alunos()
+        sexes = self.columns['CODSexo']
+        by_sex = {}
+        for label in ('Homens', 'Mulheres'):
+            codes = [code for code, name in enumerate(names) if name == label]
+            weights = np.where(np.isin(sexes, codes), alunos, 0)
+            keys, totals = self._totals(self.columns['CODCurso'], 'Cursos', weights)
+            by_sex[label] = dict(zip(keys.tolist(), totals.tolist()))
+        keys = sorted(by_sex['Homens'], key=lambda code: self.names['Cursos'][code])
+        # GROUP BY C.Curso: courses sharing a name are summed together
+        totals = {}
+        for code in keys:
+            name = self.names['Cursos'][code]
+            men, women = totals.get(name, (0, 0))
+            totals[name] = (men + by_sex['Homens'][code], women + by_sex['Mulheres'][code])
+        differences = {name: abs(men - women) for name, (men, women) in totals.items()}
+        if not differences:
+            return []
+        largest = max(differences.values())
+        return [row((name, diff)) for name, diff in differences.items() if diff == largest]
+
+    def niveis(self):
+        return self.query8()
+
+    def sexo(self):
+        row = row_type('Sexo', 'total_inscritos')
+        keys, totals = self._totals(self.columns['CODSexo'], 'Sexo', self._alunos())
+        return [row((self.names['Sexo'][k], int(t))) for k, t in zip(keys, totals)]
+
+    def natureza(self):
+        row = row_type('Natureza', 'TotalEntidades')
+        counts = {}
+        for (natureza,) in self.naturezas:
+            counts[natureza] = counts.get(natureza, 0) + 1
+        # SQLite orders the groups with NULL first, then by value
+        order = sorted(counts, key=lambda value: (value is not None, value or ''))
+        return [row((value, counts[value])) for value in order]
+
+
+# Reports the engine implements; the others always run on SQLite. Each
+# returns the rows of its SQL in the same order.
+ENGINE_REPORTS = ['query1', 'query2', 'query3', 'query6', 'query8', 'query9', 'query11',
+                  'niveis', 'sexo', 'natureza']
+
+# Prefix of the /metrics entries of the reports computed by the engine
+FINGERPRINT = 'columnar: '
+
+
+# The engine is built on first use and dropped by clear() (on the reload
+# signal), like the schema registry
+class ColumnarStore:
+    def __init__(self):
+        self._engine = None
+        self._lock = threading.Lock()
+
+    def engine(self, connect):
+        engine = self._engine
+        if engine is None:
+            with self._lock:
+                if self._engine is None:
+                    self._engine = ColumnarEngine(connect())
+                engine = self._engine
+        return engine
+
+    def clear(self):
+        self._engine = None
+
+
+# Rows of a report from its live SQL and from the engine, in the order each
+# returns them
+def compare(conn, engine, name):
+    expected = [tuple(row) for row in conn.execute(REPORTS[name])]
+    actual = [tuple(row) for row in getattr(engine, name)()]
+    return expected, actual
+
+
+def check(conn):
+    # Compare every engine report with its live SQL
+    engine = ColumnarEngine(conn)
+    failures = 0
+    for name in ENGINE_REPORTS:
+        expected, actual = compare(conn, engine, name)
+        ok = expected == actual
+        failures += not ok
+        print(f"{name:10} {'ok' if ok else 'DIFFERENT'} ({len(expected)} rows)")
+    return failures
+
+
+# Check that the columnar engine and SQLite return identical reports
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    parser = argparse.ArgumentParser(description='Columnar report engine')
+    parser.add_argument('--check', action='store_true', help='compare every engine report with SQLite')
+    parser.add_argument('--db', default=db_path, help='database file')
+    args = parser.parse_args()
+    if args.check:
+        raise SystemExit(1 if check(sqlite3.connect(args.db)) else 0)
+    parser.print_help()
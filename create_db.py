@@ -1,10 +1,21 @@
+import argparse
+import os
+import signal
+
 import pandas as pd
 import sqlite3
 
-from fontTools.subset import subset
+from reports import refresh_summaries
+from cube import build_cube
+from search import build_search_index
 
 file_path = 'DGEEC_AlunosMatriculados_2017_2018.xlsx'
+sheet_name = "Continente 2017-2018"
 db_path = "AlunosMatriculados.db"
+pid_path = "app.pid"
+chunk_size = 50000
+# Linhas lidas por índice pelo ANALYZE de um carregamento --append
+append_analysis_limit = 1000
 
 # Criar as tabelas do modelo relacional
 create_tables_sql = """
@@ -78,6 +89,22 @@ CREATE TABLE IF NOT EXISTS Distrito (
     Distrito VARCHAR(20)
 );
 
+CREATE TABLE IF NOT EXISTS Rede (
+    CODRede INTEGER PRIMARY KEY,
+    Rede VARCHAR(12)
+);
+
+CREATE TABLE IF NOT EXISTS Natureza (
+    CODNatureza INTEGER PRIMARY KEY,
+    Natureza VARCHAR(30),
+    Privado INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS Tipologia (
+    CODTipologia INTEGER PRIMARY KEY,
+    Tipologia VARCHAR(3)
+);
+
 CREATE TABLE IF NOT EXISTS Localizacao (
     CODEntidade INTEGER PRIMARY KEY REFERENCES Entidade(CODEntidade),
     CODConcelho INTEGER REFERENCES Concelho(CODConcelho)
@@ -102,9 +129,9 @@ CREATE TABLE IF NOT EXISTS Entidade (
     CODEscola INTEGER REFERENCES Escola (CODEscola),
     CODAgrupamento INTEGER REFERENCES Agrupamento (CODAgrupamento),
     CODEscolaSede INTEGER REFERENCES EscolaSede (CODEscolaSede),
-    Rede VARCHAR(12),
-    Natureza VARCHAR(20),
-    Tipologia VARCHAR(3)
+    CODRede INTEGER REFERENCES Rede (CODRede),
+    CODNatureza INTEGER REFERENCES Natureza (CODNatureza),
+    CODTipologia INTEGER REFERENCES Tipologia (CODTipologia)
 );
 
 CREATE TABLE IF NOT EXISTS Inscricoes (
@@ -136,143 +163,310 @@ CREATE TABLE IF NOT EXISTS Inscricoes (
 );
 """
 
+# Índices secundários, criados depois da inserção em massa.
+# Os índices sobre Inscricoes cobrem as agregações dos relatórios (incluem
+# NumeroAlunosMatriculados), para que sejam lidos sem aceder à tabela.
+create_indexes_sql = """
+CREATE INDEX IF NOT EXISTS idx_inscricoes_entidade ON Inscricoes (CODEntidade, CODSexo, NumeroAlunosMatriculados);
+CREATE INDEX IF NOT EXISTS idx_inscricoes_curso ON Inscricoes (CODCurso, CODSexo, NumeroAlunosMatriculados);
+CREATE INDEX IF NOT EXISTS idx_inscricoes_nivel ON Inscricoes (CODNivelEnsino, NumeroAlunosMatriculados);
+CREATE INDEX IF NOT EXISTS idx_inscricoes_sexo ON Inscricoes (CODSexo, NumeroAlunosMatriculados);
+CREATE INDEX IF NOT EXISTS idx_inscricoes_anoletivo ON Inscricoes (CODAnoLetivo);
+CREATE INDEX IF NOT EXISTS idx_localizacao_concelho ON Localizacao (CODConcelho, CODEntidade);
+CREATE INDEX IF NOT EXISTS idx_concelho_distrito ON Concelho (CODDistrito);
+CREATE INDEX IF NOT EXISTS idx_concelho_nutsiii ON Concelho (CODNUTSIII);
+CREATE INDEX IF NOT EXISTS idx_nutsiii_nutsii ON NUTSIII (CODNUTSII);
+CREATE INDEX IF NOT EXISTS idx_entidade_escola ON Entidade (CODEscola);
+CREATE INDEX IF NOT EXISTS idx_entidade_natureza ON Entidade (CODNatureza);
+-- Páginas de linhas filhas (/list/<tabela>/<id>): uma chave estrangeira e o rowid,
+-- para ler só as linhas do registo já pela ordem da chave
+CREATE INDEX IF NOT EXISTS idx_inscricoes_entidade_rowid ON Inscricoes (CODEntidade);
+CREATE INDEX IF NOT EXISTS idx_inscricoes_organizacao_rowid ON Inscricoes (CODOrganizacao);
+CREATE INDEX IF NOT EXISTS idx_inscricoes_anoescolaridade_rowid ON Inscricoes (CODAnoEscolaridade);
+CREATE INDEX IF NOT EXISTS idx_inscricoes_nivel_rowid ON Inscricoes (CODNivelEnsino);
+CREATE INDEX IF NOT EXISTS idx_inscricoes_oferta_rowid ON Inscricoes (CODOferta);
+CREATE INDEX IF NOT EXISTS idx_inscricoes_curso_rowid ON Inscricoes (CODCurso);
+CREATE INDEX IF NOT EXISTS idx_inscricoes_orientacao_rowid ON Inscricoes (CODOrientacao);
+CREATE INDEX IF NOT EXISTS idx_inscricoes_ciclo_rowid ON Inscricoes (CODCicloEstudos);
+CREATE INDEX IF NOT EXISTS idx_inscricoes_sexo_rowid ON Inscricoes (CODSexo);
+CREATE INDEX IF NOT EXISTS idx_entidade_agrupamento ON Entidade (CODAgrupamento);
+CREATE INDEX IF NOT EXISTS idx_entidade_escolasede ON Entidade (CODEscolaSede);
+CREATE INDEX IF NOT EXISTS idx_entidade_rede ON Entidade (CODRede);
+CREATE INDEX IF NOT EXISTS idx_entidade_tipologia ON Entidade (CODTipologia);
+"""
 
 
-def fill_db():
-    # Preencher as tabelas simples
-    #AnoLetivo
-    ano_letivo_data = excel_data.parse(sheet_name="Continente 2017-2018")["ANO LETIVO"].dropna().unique()
-    ano_letivo_dict = {ano: i + 1 for i, ano in enumerate(ano_letivo_data)}
-    ano_letivo_tuples = [(cod, nome) for nome, cod in ano_letivo_dict.items()]
-    cursor.executemany("INSERT INTO AnoLetivo (CODAnoLetivo, AnoLetivo) VALUES (?, ?)", ano_letivo_tuples)
-
-    # Organizacao
-    organizacao_data = excel_data.parse(sheet_name="Continente 2017-2018")["ORGANIZAÇÃO"].dropna().unique()
-    organizacao_dict = {org: i + 1 for i, org in enumerate(organizacao_data)}
-    organizacao_tuples = [(cod, nome) for nome, cod in organizacao_dict.items()]
-    cursor.executemany("INSERT INTO Organizacao (CODOrganizacao, Organizacao) VALUES (?, ?)", organizacao_tuples)
-
-    # Ano Escolaridade
-    ano_escolaridade_data = excel_data.parse(sheet_name="Continente 2017-2018")["ANO DE ESCOLARIDADE"].dropna().unique()
-    ano_escolaridade_dict = {ano: i + 1 for i, ano in enumerate(ano_escolaridade_data)}
-    ano_escolaridade_tuples = [(cod, nome) for nome, cod in ano_escolaridade_dict.items()]
-    cursor.executemany("INSERT INTO AnoEscolaridade (CODAnoEscolaridade, AnoEscolaridade) VALUES (?, ?)", ano_escolaridade_tuples)
-
-    # Nível de Ensino
-    nivel_ensino_data = excel_data.parse(sheet_name="Continente 2017-2018")["NÍVEL DE  ENSINO"].dropna().unique()
-    nivel_ensino_dict = {nivel: i + 1 for i, nivel in enumerate(nivel_ensino_data)}
-    nivel_ensino_tuples = [(cod, nome) for nome, cod in nivel_ensino_dict.items()]
-    cursor.executemany("INSERT INTO NivelEnsino (CODNivelEnsino, NivelEnsino) VALUES (?, ?)", nivel_ensino_tuples)
-
-    # Oferta
-    oferta_data = excel_data.parse(sheet_name="Continente 2017-2018")["OFERTA"].dropna().unique()
-    oferta_dict = {oferta: i + 1 for i, oferta in enumerate(oferta_data)}
-    oferta_tuples = [(cod, nome) for nome, cod in oferta_dict.items()]
-    cursor.executemany("INSERT INTO Oferta (CODOferta, Oferta) VALUES (?, ?)", oferta_tuples)
-
-    # Cursos
-    curso_data = excel_data.parse(sheet_name="Continente 2017-2018")["CURSO"].dropna().unique()
-    curso_dict = {curso: i + 1 for i, curso in enumerate(curso_data)}
-    curso_tuples = [(cod, nome) for nome, cod in curso_dict.items()]
-    cursor.executemany("INSERT INTO Cursos (CODCurso, Curso) VALUES (?, ?)", curso_tuples)
-
-    # Orientação
-    orientacao_data = excel_data.parse(sheet_name="Continente 2017-2018")["ORIENTAÇÃO"].dropna().unique()
-    orientacao_dict = {orientacao: i + 1 for i, orientacao in enumerate(orientacao_data)}
-    orientacao_tuples = [(cod, nome) for nome, cod in orientacao_dict.items()]
-    cursor.executemany("INSERT INTO Orientacao (CODOrientacao, Orientacao) VALUES (?, ?)", orientacao_tuples)
-
-    # Ciclo de Estudos
-    ciclo_estudos_data = excel_data.parse(sheet_name="Continente 2017-2018")["CICLO DE ESTUDOS"].dropna().unique()
-    ciclo_estudos_dict = {ciclo: i + 1 for i, ciclo in enumerate(ciclo_estudos_data)}
-    ciclo_estudos_tuples = [(cod, nome) for nome, cod in ciclo_estudos_dict.items()]
-    cursor.executemany("INSERT INTO CicloEstudos (CODCicloEstudos, CicloEstudos) VALUES (?, ?)", ciclo_estudos_tuples)
-
-    # Sexo
-    sexo_data = excel_data.parse(sheet_name="Continente 2017-2018")["SEXO"].dropna().unique()
-    sexo_dict = {sexo: i + 1 for i, sexo in enumerate(sexo_data)}
-    sexo_tuples = [(cod, nome) for nome, cod in sexo_dict.items()]
-    cursor.executemany("INSERT INTO Sexo (CODSexo, Sexo) VALUES (?, ?)", sexo_tuples)
-
-    # Escola
-    escola_data = excel_data.parse(sheet_name="Continente 2017-2018")[["ESCOLA", "CÓDIGO DGEEC ESCOLA"]].dropna(subset=["CÓDIGO DGEEC ESCOLA"]).drop_duplicates()
-    escola_tuples = [(row["CÓDIGO DGEEC ESCOLA"], row["ESCOLA"]) for i, row in escola_data.iterrows()]
-    cursor.executemany("INSERT INTO Escola (CODEscola, Escola) VALUES (?, ?)", escola_tuples)
-
-    # Agrupamento
-    agrupamento_data = excel_data.parse(sheet_name="Continente 2017-2018")[["AGRUPAMENTO", "CÓDIGO DGEEC AGRUPAMENTO"]].dropna(subset=["CÓDIGO DGEEC AGRUPAMENTO"]).drop_duplicates()
-    agrupamento_tuples = [(row["CÓDIGO DGEEC AGRUPAMENTO"], row["AGRUPAMENTO"]) for i, row in agrupamento_data.iterrows()]
-    cursor.executemany("INSERT INTO Agrupamento (CODAgrupamento, Agrupamento) VALUES (?, ?)", agrupamento_tuples)
-
-    # Escola Sede
-    escola_sede_data = excel_data.parse(sheet_name="Continente 2017-2018")[["ESCOLA SEDE", "CÓDIGO DGEEC ESCOLA SEDE"]].dropna(subset=["CÓDIGO DGEEC ESCOLA SEDE"]).drop_duplicates()
-    escola_sede_tuples = [(row["CÓDIGO DGEEC ESCOLA SEDE"], row["ESCOLA SEDE"]) for i, row in escola_sede_data.iterrows()]
-    cursor.executemany("INSERT INTO EscolaSede (CODEscolaSede, EscolaSede) VALUES (?, ?)", escola_sede_tuples)
-
-    # Distrito
-    distrito_data = excel_data.parse(sheet_name="Continente 2017-2018")["DISTRITO"].dropna().unique()
-    distrito_dict = {distrito: i + 1 for i, distrito in enumerate(distrito_data)}
-    distrito_tuples = [(cod, nome) for nome, cod in distrito_dict.items()]
-    cursor.executemany("INSERT INTO Distrito (CODDistrito, Distrito) VALUES (?, ?)", distrito_tuples)
-
-    # NUTS II
-    nutsii_data = excel_data.parse(sheet_name="Continente 2017-2018")["NUTS II (2013)"].dropna().unique()
-    nutsii_dict = {nutsii: i + 1 for i, nutsii in enumerate(nutsii_data)}
-    nutsii_tuples = [(cod, nome) for nome, cod in nutsii_dict.items()]
-    cursor.executemany("INSERT INTO NUTSII (CODNUTSII, NUTSII) VALUES (?, ?)", nutsii_tuples)
-
-    # NUTS III
-    nutsiii_data = excel_data.parse(sheet_name="Continente 2017-2018")["NUTS III (2013)"].dropna().unique()
-    nutsiii_dict = {nutsiii: i + 1 for i, nutsiii in enumerate(nutsiii_data)}
-    nutsiii_data_comp = excel_data.parse(sheet_name="Continente 2017-2018")[["NUTS III (2013)", "NUTS II (2013)"]].drop_duplicates()
-    nutsiii_tuples = [(nutsiii_dict.get(row["NUTS III (2013)"]), row["NUTS III (2013)"], nutsii_dict.get(row["NUTS II (2013)"]))
-                    for i, row in nutsiii_data_comp.iterrows()]
-    cursor.executemany("INSERT INTO NUTSIII (CODNUTSIII, NUTSIII, CODNUTSII) VALUES (?, ?, ?)", nutsiii_tuples)
-
-    # Concelhos
-    concelho_data = excel_data.parse(sheet_name="Continente 2017-2018")["CONCELHO"].dropna().unique()
-    concelho_dict = {concelhos: i + 1 for i, concelhos in enumerate(concelho_data)}
-    concelho_data_comp = excel_data.parse(sheet_name="Continente 2017-2018")[["CONCELHO", "DISTRITO", "NUTS III (2013)"]].drop_duplicates()
-    concelho_tuples = [(concelho_dict.get(row["CONCELHO"]), row["CONCELHO"], distrito_dict.get(row["DISTRITO"]), nutsiii_dict.get(row["NUTS III (2013)"]))
-                    for i, row in concelho_data_comp.iterrows()]
-    cursor.executemany("INSERT INTO Concelho (CODConcelho, Concelho, CODDistrito, CODNUTSIII) VALUES (?, ?, ?, ?)", concelho_tuples)
-
-    # Entidade
-    entidade_data_comp = excel_data.parse(sheet_name="Continente 2017-2018")[["CÓDICO DGEEC ENTIDADE", "ENTIDADE", "CÓDIGO DGEEC ESCOLA", "CÓDIGO DGEEC AGRUPAMENTO", "CÓDIGO DGEEC ESCOLA SEDE", "REDE",
-                                                                            "NATUREZA", "TIPOLOGIA"]].drop_duplicates()
-    entidade_tuples = [(row["CÓDICO DGEEC ENTIDADE"], row["ENTIDADE"], row["CÓDIGO DGEEC ESCOLA"], row["CÓDIGO DGEEC AGRUPAMENTO"], row["CÓDIGO DGEEC ESCOLA SEDE"],
-                        row["REDE"], row["NATUREZA"], row["TIPOLOGIA"]) for i, row in entidade_data_comp.iterrows()]
-    cursor.executemany("INSERT INTO Entidade (CODEntidade, Entidade, CODEscola, CODAgrupamento, CODEscolaSede, Rede, Natureza, Tipologia) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", entidade_tuples)
+# Dimensões com código atribuído pelo loader: (tabela, código, nome, coluna do Excel)
+DIMENSIONS = [
+    ("AnoLetivo", "CODAnoLetivo", "AnoLetivo", "ANO LETIVO"),
+    ("Organizacao", "CODOrganizacao", "Organizacao", "ORGANIZAÇÃO"),
+    ("AnoEscolaridade", "CODAnoEscolaridade", "AnoEscolaridade", "ANO DE ESCOLARIDADE"),
+    ("NivelEnsino", "CODNivelEnsino", "NivelEnsino", "NÍVEL DE  ENSINO"),
+    ("Oferta", "CODOferta", "Oferta", "OFERTA"),
+    ("Cursos", "CODCurso", "Curso", "CURSO"),
+    ("Orientacao", "CODOrientacao", "Orientacao", "ORIENTAÇÃO"),
+    ("CicloEstudos", "CODCicloEstudos", "CicloEstudos", "CICLO DE ESTUDOS"),
+    ("Sexo", "CODSexo", "Sexo", "SEXO"),
+    ("Distrito", "CODDistrito", "Distrito", "DISTRITO"),
+    ("NUTSII", "CODNUTSII", "NUTSII", "NUTS II (2013)"),
+    ("NUTSIII", "CODNUTSIII", "NUTSIII", "NUTS III (2013)"),
+    ("Concelho", "CODConcelho", "Concelho", "CONCELHO"),
+    ("Rede", "CODRede", "Rede", "REDE"),
+    ("Natureza", "CODNatureza", "Natureza", "NATUREZA"),
+    ("Tipologia", "CODTipologia", "Tipologia", "TIPOLOGIA"),
+]
+
+# Dimensões que já trazem o código DGEEC no Excel: (tabela, código, nome, coluna do código, coluna do nome)
+CODED_DIMENSIONS = [
+    ("Escola", "CODEscola", "Escola", "CÓDIGO DGEEC ESCOLA", "ESCOLA"),
+    ("Agrupamento", "CODAgrupamento", "Agrupamento", "CÓDIGO DGEEC AGRUPAMENTO", "AGRUPAMENTO"),
+    ("EscolaSede", "CODEscolaSede", "EscolaSede", "CÓDIGO DGEEC ESCOLA SEDE", "ESCOLA SEDE"),
+]
+
+# Tabelas sem código atribuído pelo loader, com a respetiva chave
+KEYED_TABLES = [
+    ("NUTSIII", "CODNUTSIII"),
+    ("Concelho", "CODConcelho"),
+    ("Escola", "CODEscola"),
+    ("Agrupamento", "CODAgrupamento"),
+    ("EscolaSede", "CODEscolaSede"),
+    ("Entidade", "CODEntidade"),
+    ("Localizacao", "CODEntidade"),
+]
+
+INSCRICOES_COLUMNS = ["CODAnoLetivo", "CODEntidade", "CODOrganizacao", "CODAnoEscolaridade", "CODNivelEnsino",
+                      "CODOferta", "CODCurso", "CODOrientacao", "CODCicloEstudos", "CODSexo", "NumeroAlunosMatriculados"]
+INSCRICOES_KEY = INSCRICOES_COLUMNS[:-1]
+
+# Colunas do Excel usadas pelo loader
+SOURCE_COLUMNS = [column for _, _, _, column in DIMENSIONS]
+SOURCE_COLUMNS += [column for dimension in CODED_DIMENSIONS for column in dimension[3:]]
+SOURCE_COLUMNS += ["CÓDICO DGEEC ENTIDADE", "ENTIDADE", "NÚMERO DE ALUNOS MATRICULADOS"]
+
+
+def read_sheet(path, sheet):
+    # Ler a folha (ou o CSV) uma única vez, apenas com as colunas usadas
+    if path.lower().endswith(".csv"):
+        return pd.read_csv(path, usecols=SOURCE_COLUMNS)
+    return pd.read_excel(path, sheet_name=sheet, usecols=SOURCE_COLUMNS)
+
+
+def iter_sheet(path, sheet, chunk_size):
+    # Ler a origem em blocos de chunk_size linhas, sem a carregar toda em memória
+    if path.lower().endswith(".csv"):
+        yield from pd.read_csv(path, usecols=SOURCE_COLUMNS, chunksize=chunk_size)
+        return
+
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True)
+    try:
+        rows = workbook[sheet].iter_rows(values_only=True)
+        header = list(next(rows))
+        positions = [header.index(column) for column in SOURCE_COLUMNS]
+        batch = []
+        for row in rows:
+            if all(value is None for value in row):
+                continue
+            batch.append([row[i] for i in positions])
+            if len(batch) == chunk_size:
+                yield pd.DataFrame(batch, columns=SOURCE_COLUMNS)
+                batch = []
+        if batch:
+            yield pd.DataFrame(batch, columns=SOURCE_COLUMNS)
+    finally:
+        workbook.close()
+
+
+def column_values(series):
+    # Lista com tipos nativos do Python (o sqlite3 não aceita escalares NumPy); valores em falta passam a None
+    return series.astype(object).where(series.notna(), None).tolist()
+
+
+def insert_frame(cursor, table, frame, verb="INSERT"):
+    # executemany alimentado pelas colunas do DataFrame, sem iterrows
+    columns = ", ".join(frame.columns)
+    placeholders = ", ".join("?" * len(frame.columns))
+    rows = zip(*(column_values(frame[column]) for column in frame.columns))
+    cursor.executemany(f"{verb} INTO {table} ({columns}) VALUES ({placeholders})", rows)
+
+
+class LoadState:
+    # Estado de um carregamento, mantido entre blocos: o código de cada membro
+    # das dimensões e as chaves já inseridas nas restantes tabelas.
+    # Com um cursor, parte do conteúdo atual da base de dados (modo --append).
+    def __init__(self, cursor=None):
+        self.codes = {table: {} for table, _, _, _ in DIMENSIONS}
+        self.next_code = {table: 1 for table, _, _, _ in DIMENSIONS}
+        self.seen = {}
+        if cursor is None:
+            return
+        for table, code, name, _ in DIMENSIONS:
+            mapping = self.codes[table]
+            for member, member_code in cursor.execute(f"SELECT {name}, {code} FROM {table}"):
+                mapping[str(member)] = member_code
+            self.next_code[table] = max(mapping.values(), default=0) + 1
+        for table, key in KEYED_TABLES:
+            self.seen[table] = {row[0] for row in cursor.execute(f"SELECT {key} FROM {table}")}
+
+
+def encode(cursor, state, dimension, values):
+    # Códigos de uma coluna do bloco; os membros novos recebem, pela ordem de
+    # aparecimento, os códigos seguintes (valores em falta ficam sem código).
+    # Os membros são comparados como texto, tal como ficam guardados.
+    table, code, name, _ = dimension
+    mapping = state.codes[table]
+    members = values.astype("string")
+    _, new_members = pd.factorize(members[members.notna() & ~members.isin(list(mapping))])
+    if len(new_members):
+        first = state.next_code[table]
+        new_codes = range(first, first + len(new_members))
+        state.next_code[table] = first + len(new_members)
+        mapping.update(zip(new_members.tolist(), new_codes))
+        if table not in ("NUTSIII", "Concelho"):
+            insert_frame(cursor, table, pd.DataFrame({code: new_codes, name: new_members}))
+    return members.map(mapping).astype("Int64")
+
+
+def insert_new(cursor, state, table, frame):
+    # Inserir apenas as linhas cuja chave (primeira coluna) ainda não foi vista
+    key = frame.columns[0]
+    seen = state.seen.setdefault(table, set())
+    frame = frame.dropna(subset=[key]).drop_duplicates(subset=[key])
+    frame = frame[~frame[key].isin(list(seen))]
+    insert_frame(cursor, table, frame)
+    seen.update(column_values(frame[key]))
+
+
+def load_chunk(cursor, state, data, target="Inscricoes"):
+    codes = pd.DataFrame(index=data.index)
+    for dimension in DIMENSIONS:
+        codes[dimension[1]] = encode(cursor, state, dimension, data[dimension[3]])
+
+    # NUTS III e Concelhos referem outras dimensões
+    insert_new(cursor, state, "NUTSIII", pd.DataFrame({
+        "CODNUTSIII": codes["CODNUTSIII"], "NUTSIII": data["NUTS III (2013)"], "CODNUTSII": codes["CODNUTSII"]}))
+    insert_new(cursor, state, "Concelho", pd.DataFrame({
+        "CODConcelho": codes["CODConcelho"], "Concelho": data["CONCELHO"],
+        "CODDistrito": codes["CODDistrito"], "CODNUTSIII": codes["CODNUTSIII"]}))
+
+    # Escola, Agrupamento e Escola Sede
+    for table, code, name, code_column, name_column in CODED_DIMENSIONS:
+        insert_new(cursor, state, table, data[[code_column, name_column]].set_axis([code, name], axis=1))
+
+    # Entidade, com a rede, natureza e tipologia guardadas como códigos
+    entidade = data[["CÓDICO DGEEC ENTIDADE", "ENTIDADE", "CÓDIGO DGEEC ESCOLA", "CÓDIGO DGEEC AGRUPAMENTO",
+                     "CÓDIGO DGEEC ESCOLA SEDE"]]
+    entidade = entidade.set_axis(["CODEntidade", "Entidade", "CODEscola", "CODAgrupamento", "CODEscolaSede"], axis=1)
+    insert_new(cursor, state, "Entidade", entidade.assign(
+        CODRede=codes["CODRede"], CODNatureza=codes["CODNatureza"], CODTipologia=codes["CODTipologia"]))
 
     # Localização
-    localizacao_data_comp = excel_data.parse(sheet_name="Continente 2017-2018")[["CÓDICO DGEEC ENTIDADE", "CONCELHO"]].drop_duplicates()
-    localizacao_tuples = [(row["CÓDICO DGEEC ENTIDADE"], concelho_dict.get(row["CONCELHO"]))
-                        for i, row in localizacao_data_comp.iterrows()]
-    cursor.executemany("INSERT INTO Localizacao (CODEntidade, CODConcelho) VALUES (?, ?)", localizacao_tuples)
-
-    # Inscrições
-    inscricoes_data_comp = excel_data.parse(sheet_name="Continente 2017-2018")[["ANO LETIVO", "CÓDICO DGEEC ENTIDADE", "OFERTA", "NÍVEL DE  ENSINO", "ORGANIZAÇÃO", "CICLO DE ESTUDOS", "CURSO", "SEXO",
-                                                                            "ORIENTAÇÃO", "ANO DE ESCOLARIDADE", "NÚMERO DE ALUNOS MATRICULADOS"]].drop_duplicates()
-    inscricoes_tuples = [(ano_letivo_dict.get(row["ANO LETIVO"]), row["CÓDICO DGEEC ENTIDADE"], organizacao_dict.get(row["ORGANIZAÇÃO"]), ano_escolaridade_dict.get(row["ANO DE ESCOLARIDADE"]),
-                        nivel_ensino_dict.get(row["NÍVEL DE  ENSINO"]), oferta_dict.get(row["OFERTA"]), curso_dict.get(row["CURSO"]), orientacao_dict.get(row["ORIENTAÇÃO"]),
-                        ciclo_estudos_dict.get(row["CICLO DE ESTUDOS"]), sexo_dict.get(row["SEXO"]), row["NÚMERO DE ALUNOS MATRICULADOS"])
-                        for i, row in inscricoes_data_comp.iterrows()]
-    cursor.executemany("INSERT INTO Inscricoes (CODAnoLetivo, CODEntidade, CODOrganizacao, CODAnoEscolaridade, CODNivelEnsino,"
-                    "CODOferta, CODCurso, CODOrientacao, CODCicloEstudos, CODSexo, NumeroAlunosMatriculados)"
-                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", inscricoes_tuples)
-
-    # Fechar a conexão após terminar
+    insert_new(cursor, state, "Localizacao", pd.DataFrame({
+        "CODEntidade": data["CÓDICO DGEEC ENTIDADE"], "CODConcelho": codes["CODConcelho"]}))
+
+    # Inscrições (linhas repetidas entre blocos são ignoradas pela chave primária)
+    inscricoes = codes.assign(CODEntidade=data["CÓDICO DGEEC ENTIDADE"],
+                              NumeroAlunosMatriculados=data["NÚMERO DE ALUNOS MATRICULADOS"])
+    insert_frame(cursor, target, inscricoes[INSCRICOES_COLUMNS].drop_duplicates(), verb="INSERT OR IGNORE")
+
+
+def fill_db(conn, chunks, append=False):
+    # Cada bloco é inserido e confirmado numa transação própria.
+    # Em modo append, as dimensões reutilizam os códigos existentes e as
+    # inscrições ficam numa tabela temporária até à troca dos anos letivos.
+    cursor = conn.cursor()
+    state = LoadState(cursor if append else None)
+    target = "Inscricoes"
+    if append:
+        target = "temp.InscricoesNovas"
+        cursor.execute("CREATE TEMP TABLE InscricoesNovas AS SELECT * FROM Inscricoes WHERE 0")
+        cursor.execute(f"CREATE UNIQUE INDEX temp.idx_inscricoes_novas ON InscricoesNovas ({', '.join(INSCRICOES_KEY)})")
+    for number, chunk in enumerate(chunks, 1):
+        load_chunk(cursor, state, chunk, target)
+        conn.commit()
+        print(f"Bloco {number}: {len(chunk)} linhas")
+    # Natureza privada (1) ou pública (0), para os relatórios filtrarem por código;
+    # as restantes ficam a NULL e não contam como nenhuma das duas
+    conn.execute("UPDATE Natureza SET Privado = CASE WHEN Natureza LIKE '%privado%' THEN 1 "
+                 "WHEN Natureza LIKE '%Público%' THEN 0 END WHERE Privado IS NULL")
+    conn.commit()
+    if append:
+        replace_years(conn)
+
+
+def replace_years(conn):
+    # Trocar a partição de cada ano letivo carregado numa só transação:
+    # o custo depende apenas das inscrições desses anos
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_inscricoes_anoletivo ON Inscricoes (CODAnoLetivo)")
+    with conn:
+        years = [row[0] for row in conn.execute("SELECT DISTINCT CODAnoLetivo FROM temp.InscricoesNovas")]
+        conn.executemany("DELETE FROM Inscricoes WHERE CODAnoLetivo = ?", [(year,) for year in years])
+        conn.execute("INSERT INTO Inscricoes SELECT * FROM temp.InscricoesNovas")
+    conn.execute("DROP TABLE temp.InscricoesNovas")
+    print(f"Anos letivos substituídos: {', '.join(map(str, years))}")
+
+
+def create_indexes(conn, append=False):
+    # Criar os índices só depois das inserções mantém o carregamento rápido;
+    # o ANALYZE dá ao planeador as estatísticas para os escolher. Em modo
+    # append, o ANALYZE lê no máximo append_analysis_limit linhas de cada
+    # índice, para não custar mais a cada ano letivo acumulado
+    conn.executescript(create_indexes_sql)
+    if append:
+        conn.execute(f"PRAGMA analysis_limit = {append_analysis_limit}")
+    conn.execute("ANALYZE")
+    conn.execute("PRAGMA analysis_limit = 0")
     conn.commit()
-    conn.close()
+
+
+def notify_app():
+    # Avisar a aplicação em execução (se existir) para descartar as caches
+    if not hasattr(signal, 'SIGHUP') or not os.path.exists(pid_path):
+        return
+    with open(pid_path) as f:
+        pid = int(f.read())
+    try:
+        os.kill(pid, signal.SIGHUP)
+    except ProcessLookupError:
+        pass
 
 
 if __name__ == '__main__':
-    excel_data = pd.ExcelFile(file_path)
+    parser = argparse.ArgumentParser(description="Carregar o Excel da DGEEC na base de dados")
+    parser.add_argument("--file", default=file_path, help="ficheiro XLSX ou CSV de origem")
+    parser.add_argument("--sheet", default=sheet_name, help="folha do ficheiro XLSX")
+    parser.add_argument("--stream", action="store_true",
+                        help="ler e inserir a origem em blocos, com memória constante")
+    parser.add_argument("--chunk-size", type=int, default=chunk_size, help="linhas por bloco em --stream")
+    parser.add_argument("--append", action="store_true",
+                        help="acrescentar a uma base de dados existente, substituindo só os anos letivos da origem")
+    args = parser.parse_args()
 
     conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    cursor.executescript(create_tables_sql)
+    # WAL permite que a aplicação (só de leitura) continue a ler durante o carregamento
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.executescript(create_tables_sql)
     conn.commit()
 
-    fill_db
\ No newline at end of file
+    if args.stream:
+        fill_db(conn, iter_sheet(args.file, args.sheet, args.chunk_size), args.append)
+    else:
+        fill_db(conn, [read_sheet(args.file, args.sheet)], args.append)
+    create_indexes(conn, args.append)
+
+    # Materializar os relatórios da página /queries e dos gráficos
+    refresh_summaries(conn)
+    # Cubo de inscrições e entidades por nível geográfico, sexo, nível de ensino e natureza
+    build_cube(conn)
+    # Índice de pesquisa (FTS5) dos nomes de escolas, entidades, agrupamentos e cursos
+    build_search_index(conn)
+    notify_app()
+
+    # Passar o WAL para o ficheiro principal e fechar a conexão após terminar
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+
+    # Pré-gerar as páginas mais pesadas a partir dos novos dados (ver snapshots.py)
+    import app
+    app.export_snapshots()
@@ -0,0 +1,125 @@
+import argparse
+import itertools
+import logging
+import sqlite3
+
+db_path = "AlunosMatriculados.db"
+
+CUBE_TABLE = 'Cubo'
+
+# Geography levels of the cube: code column and name of each member, and the
+# ancestor levels whose codes are stored next to it (for drill-down filters).
+# Entidade -> Concelho -> Distrito and Entidade -> Concelho -> NUTSIII -> NUTSII.
+LEVELS = {
+    'entidade': ('CODEntidade', 'Entidade', ['concelho', 'distrito', 'nutsiii', 'nutsii']),
+    'concelho': ('CODConcelho', 'Concelho', ['distrito', 'nutsiii', 'nutsii']),
+    'distrito': ('CODDistrito', 'Distrito', []),
+    'nutsiii': ('CODNUTSIII', 'NUTSIII', ['nutsii']),
+    'nutsii': ('CODNUTSII', 'NUTSII', []),
+}
+
+# Attributes crossed with every level; NULL in the cube means "all values"
+ATTRIBUTES = ['CODSexo', 'CODNivelEnsino', 'CODNatureza']
+
+# Enrollments per entity, sex and education level, with the entity's
+# geography and nature: the grain every cell is rolled up from
+BASE_SQL = (
+    'SELECT I.CODEntidade, E.Entidade, E.CODNatureza, '
+    'C.CODConcelho, C.Concelho, D.CODDistrito, D.Distrito, '
+    'N3.CODNUTSIII, N3.NUTSIII, N2.CODNUTSII, N2.NUTSII, '
+    'I.CODSexo, I.CODNivelEnsino, SUM(I.NumeroAlunosMatriculados) AS Alunos '
+    'FROM Inscricoes I '
+    'JOIN Entidade E ON E.CODEntidade = I.CODEntidade '
+    'JOIN Localizacao L ON L.CODEntidade = I.CODEntidade '
+    'JOIN Concelho C ON C.CODConcelho = L.CODConcelho '
+    'JOIN Distrito D ON D.CODDistrito = C.CODDistrito '
+    'JOIN NUTSIII N3 ON N3.CODNUTSIII = C.CODNUTSIII '
+    'JOIN NUTSII N2 ON N2.CODNUTSII = N3.CODNUTSII '
+    'GROUP BY I.CODEntidade, I.CODSexo, I.CODNivelEnsino'
+)
+
+CREATE_CUBE_SQL = f'''
+CREATE TABLE {CUBE_TABLE} (
+    Nivel VARCHAR(8),
+    Codigo INTEGER,
+    Nome VARCHAR(255),
+    CODConcelho INTEGER,
+    CODDistrito INTEGER,
+    CODNUTSIII INTEGER,
+    CODNUTSII INTEGER,
+    CODSexo INTEGER,
+    CODNivelEnsino INTEGER,
+    CODNatureza INTEGER,
+    TotalAlunos INTEGER,
+    TotalEntidades INTEGER
+)'''
+
+
+def cell_sql(level, attributes):
+    # One level crossed with a subset of the attributes; the others are
+    # rolled up and stored as NULL
+    code, name, ancestors = LEVELS[level]
+    ancestor_codes = {LEVELS[ancestor][0] for ancestor in ancestors}
+    columns = [f"'{level}'", code, name]
+    columns += [column if column in ancestor_codes else 'NULL'
+                for column in ('CODConcelho', 'CODDistrito', 'CODNUTSIII', 'CODNUTSII')]
+    columns += [column if column in attributes else 'NULL' for column in ATTRIBUTES]
+    columns += ['SUM(Alunos)', 'COUNT(DISTINCT CODEntidade)']
+    group_by = [code] + list(attributes)
+    return f"SELECT {', '.join(columns)} FROM CuboBase GROUP BY {', '.join(group_by)}"
+
+
+def build_cube(conn):
+    # Rebuild the cube in a single transaction: every level crossed with the
+    # 8 combinations of the attributes, rolled up from the entity-level base
+    conn.execute('BEGIN')
+    try:
+        conn.execute('DROP TABLE IF EXISTS temp.CuboBase')
+        conn.execute(f'CREATE TEMP TABLE CuboBase AS {BASE_SQL}')
+        conn.execute(f'DROP TABLE IF EXISTS {CUBE_TABLE}')
+        conn.execute(CREATE_CUBE_SQL)
+        for level in LEVELS:
+            for n in range(len(ATTRIBUTES) + 1):
+                for attributes in itertools.combinations(ATTRIBUTES, n):
+                    conn.execute(f'INSERT INTO {CUBE_TABLE} {cell_sql(level, attributes)}')
+        conn.execute(f'CREATE INDEX idx_cubo ON {CUBE_TABLE} (Nivel, CODSexo, CODNivelEnsino, CODNatureza)')
+        conn.execute('DROP TABLE temp.CuboBase')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    count = conn.execute(f'SELECT COUNT(*) FROM {CUBE_TABLE}').fetchone()[0]
+    logging.info('Built cube with {} cells'.format(count))
+
+
+# Cells of one level, optionally inside one ancestor member (drill-down),
+# for one value, every value ('*') or the total (None) of each attribute
+def cube_query(level, attributes, ancestors):
+    code, name, allowed = LEVELS[level]
+    where = ['Nivel = ?']
+    args = [level]
+    for ancestor, value in ancestors.items():
+        if ancestor not in allowed:
+            raise ValueError(f'{level} is not inside {ancestor}')
+        where.append(f'{LEVELS[ancestor][0]} = ?')
+        args.append(value)
+    for column in ATTRIBUTES:
+        value = attributes.get(column)
+        if value == '*':
+            where.append(f'{column} IS NOT NULL')
+        else:
+            where.append(f'{column} IS ?')
+            args.append(value)
+    sql = (f"SELECT Codigo AS {code}, Nome AS {name}, {', '.join(ATTRIBUTES)}, TotalAlunos, TotalEntidades "
+           f"FROM {CUBE_TABLE} WHERE {' AND '.join(where)} ORDER BY Codigo, {', '.join(ATTRIBUTES)}")
+    return sql, args
+
+
+# Rebuild the cube of an existing database after its data changed
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    parser = argparse.ArgumentParser(description='Rebuild the enrollment cube')
+    parser.parse_args()
+    conn = sqlite3.connect(db_path)
+    build_cube(conn)
+    conn.close()
@@ -0,0 +1,135 @@
+import csv
+import io
+import json
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Parquet exports are only offered when pyarrow is installed
+    pyarrow = None
+
+# Arguments of the export routes that are not column filters
+RESERVED_ARGS = {'format', 'columns'}
+
+
+def quote(column):
+    return '"{}"'.format(column.replace('"', '""'))
+
+
+# Projection and filters of an export request, checked against the columns of
+# the table or report: ?columns=a,b keeps those columns, every other argument
+# (column=value, column=v1,v2 or the column repeated) keeps the rows whose
+# column has one of the values. Raises ValueError for unknown columns.
+def parse_request(args, available):
+    columns = [column for column in args.get('columns', '').split(',') if column] or list(available)
+    unknown = [column for column in columns if column not in available]
+    filters = {}
+    for name, value in args.items(multi=True):
+        if name in RESERVED_ARGS:
+            continue
+        if name not in available:
+            unknown.append(name)
+            continue
+        filters.setdefault(name, []).extend(coerce(v) for v in value.split(',') if v)
+    if unknown:
+        raise ValueError(f"Unknown column: {', '.join(unknown)}")
+    for name, values in filters.items():
+        if not values:
+            raise ValueError(f'Filter {name} takes at least one value')
+    return columns, list(filters.items())
+
+
+def coerce(value):
+    # Integer arguments compare as integers even with computed report columns,
+    # which have no type affinity to convert them
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def export_sql(source, columns, filters, order_by=None):
+    where = []
+    args = []
+    for name, values in filters:
+        where.append(f"{quote(name)} IN ({', '.join('?' * len(values))})")
+        args += values
+    sql = f"SELECT {', '.join(quote(column) for column in columns)} FROM {source}"
+    if where:
+        sql += f" WHERE {' AND '.join(where)}"
+    if order_by:
+        sql += f' ORDER BY {order_by}'
+    return sql, args
+
+
+# Writers: turn (columns, batches of rows) into a stream of byte chunks, one
+# or more per batch, so that nothing but the current batch is held in memory
+def write_csv(columns, batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def write_ndjson(columns, batches):
+    for rows in batches:
+        yield ''.join(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n' for row in rows).encode()
+
+
+# File object handing the bytes pyarrow writes over to the response, chunk by
+# chunk, instead of keeping the whole file
+class ChunkSink:
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+# One Parquet row group per batch; the types are inferred from the first one
+def write_parquet(columns, batches):
+    sink = ChunkSink()
+    writer = None
+    for rows in batches:
+        table = pyarrow.Table.from_pydict({column: [row[i] for row in rows] for i, column in enumerate(columns)})
+        if writer is None:
+            writer = pyarrow.parquet.ParquetWriter(sink, table.schema)
+        writer.write_table(table.cast(writer.schema))
+        yield sink.take()
+    if writer is None:
+        writer = pyarrow.parquet.ParquetWriter(sink, pyarrow.schema([(column, pyarrow.null()) for column in columns]))
+    writer.close()
+    yield sink.take()
+
+
+# format: (writer, content type, file extension)
+FORMATS = {
+    'csv': (write_csv, 'text/csv; charset=utf-8', 'csv'),
+    'ndjson': (write_ndjson, 'application/x-ndjson', 'ndjson'),
+}
+if pyarrow:
+    FORMATS['parquet'] = (write_parquet, 'application/vnd.apache.parquet', 'parquet')
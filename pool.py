@@ -0,0 +1,98 @@
+import logging
+import sqlite3
+import threading
+import weakref
+
+# Per-connection settings, applied once when a connection is opened.
+# WAL is a property of the database file and is set by the loader.
+PRAGMAS = {
+    'mmap_size': 268435456,  # map up to 256 MiB of the file instead of copying pages
+    'cache_size': -65536,    # 64 MiB page cache (negative values are KiB)
+    'temp_store': 'MEMORY',  # sorts and temp B-trees of GROUP BY/ORDER BY in memory
+}
+
+
+# A thread's connection, held in the thread's local storage: when the thread
+# ends and the holder is collected, its finalizer closes the connection.
+# uses counts the connection() calls not yet matched by a release(), i.e.
+# the requests (app contexts) using it on that thread.
+class _Holder:
+    def __init__(self, conn, generation):
+        self.conn = conn
+        self.generation = generation
+        self.uses = 0
+
+
+# One read-only connection per worker thread, tuned once and reused by every
+# request served on that thread, and closed when the thread ends
+class ConnectionPool:
+    def __init__(self, path, read_only=True, pragmas=PRAGMAS):
+        self.path = path
+        self.read_only = read_only
+        self.pragmas = pragmas
+        self.generation = 0
+        self._local = threading.local()
+        self._holders = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if self.read_only:
+            conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        logging.info('Opened pooled connection to {}'.format(self.path))
+        return conn
+
+    def connection(self):
+        holder = getattr(self._local, 'holder', None)
+        with self._lock:
+            if holder is not None and holder.generation == self.generation:
+                holder.uses += 1
+                return holder.conn
+        if holder is not None:
+            self._discard(holder)
+        holder = _Holder(self._open(), self.generation)
+        weakref.finalize(holder, holder.conn.close)
+        holder.uses = 1
+        self._local.holder = holder
+        with self._lock:
+            self._holders.add(holder)
+        return holder.conn
+
+    # The calling thread is done with its connection (end of the request)
+    def release(self):
+        holder = getattr(self._local, 'holder', None)
+        if holder is not None and holder.uses:
+            with self._lock:
+                holder.uses -= 1
+
+    def _discard(self, holder):
+        with self._lock:
+            self._holders.discard(holder)
+        holder.conn.close()
+
+    # Make every thread reopen its connection on next use (e.g. after the
+    # database file was replaced by a new load); the idle connections are
+    # closed now, the ones in use by their thread on its next request (or
+    # when it ends)
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            idle = [holder for holder in self._holders if not holder.uses]
+            for holder in idle:
+                self._holders.discard(holder)
+        for holder in idle:
+            holder.conn.close()
+
+    # Close every connection; only safe while no request is running, e.g.
+    # in the master process before forking workers
+    def close_all(self):
+        with self._lock:
+            holders = list(self._holders)
+            self._holders = weakref.WeakSet()
+        for holder in holders:
+            holder.conn.close()
+        self._local = threading.local()
@@ -0,0 +1,136 @@
+import functools
+import logging
+import re
+import threading
+import time
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+# Collapse whitespace once per distinct statement; the normalized text is
+# also the statement's fingerprint in the stats
+@functools.lru_cache(maxsize=1024)
+def normalize(sql):
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+# Fingerprint under which the statements beyond max_entries are aggregated
+OTHER_STATEMENTS = '(other statements)'
+
+
+# Aggregated timings and row counts per statement fingerprint. Some routes
+# build their SQL from the request (e.g. the /export projections), so at most
+# max_entries fingerprints are kept; later ones share a single entry.
+class QueryStats:
+    def __init__(self, max_entries=500):
+        self.max_entries = max_entries
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, sql, seconds, rows, plan=None):
+        with self._lock:
+            if sql not in self._stats and len(self._stats) >= self.max_entries:
+                sql = OTHER_STATEMENTS
+            entry = self._stats.get(sql)
+            if entry is None:
+                entry = self._stats[sql] = {'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'rows': 0, 'slow': 0}
+            ms = seconds * 1000
+            entry['calls'] += 1
+            entry['total_ms'] += ms
+            entry['max_ms'] = max(entry['max_ms'], ms)
+            entry['rows'] += rows
+            if plan is not None:
+                entry['slow'] += 1
+                entry['plan'] = plan
+
+    def snapshot(self):
+        with self._lock:
+            stats = [dict(entry, sql=sql, mean_ms=entry['total_ms'] / entry['calls'])
+                     for sql, entry in self._stats.items()]
+        return sorted(stats, key=lambda entry: entry['total_ms'], reverse=True)
+
+    def clear(self):
+        with self._lock:
+            self._stats.clear()
+
+
+# Cursor proxy that times a statement and records it once in the stats when
+# its rows have been consumed (or the cursor is dropped). Only the time spent
+# inside execute() and the fetch calls counts: a streamed cursor is read
+# between template chunks and client writes, which are not the statement's.
+class TimedCursor:
+    def __init__(self, cursor, sql, args, stats, slow_seconds):
+        self._cursor = cursor
+        self._sql = sql
+        self._args = args
+        self._stats = stats
+        self._slow_seconds = slow_seconds
+        self._rows = 0
+        # Nothing to record if the statement itself fails
+        self._done = True
+        start = time.perf_counter()
+        cursor.execute(sql, args or ())
+        self._elapsed = time.perf_counter() - start
+        self._done = False
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self._cursor.fetchone()
+        self._elapsed += time.perf_counter() - start
+        if row is None:
+            self._finish()
+        else:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, size):
+        start = time.perf_counter()
+        rows = self._cursor.fetchmany(size)
+        self._elapsed += time.perf_counter() - start
+        self._rows += len(rows)
+        if len(rows) < size:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self._cursor.fetchall()
+        self._elapsed += time.perf_counter() - start
+        self._rows += len(rows)
+        self._finish()
+        return rows
+
+    def __iter__(self):
+        rows = iter(self._cursor)
+        while True:
+            start = time.perf_counter()
+            row = next(rows, None)
+            self._elapsed += time.perf_counter() - start
+            if row is None:
+                break
+            self._rows += 1
+            yield row
+        self._finish()
+
+    def __del__(self):
+        self._finish()
+
+    def _finish(self):
+        if self._done:
+            return
+        self._done = True
+        elapsed = self._elapsed
+        plan = None
+        if elapsed >= self._slow_seconds:
+            try:
+                plan = [row[3] for row in self._cursor.connection.execute(
+                    f'EXPLAIN QUERY PLAN {self._sql}', self._args or ())]
+            except Exception as e:
+                plan = [f'unavailable: {e}']
+            logging.warning('Slow query ({:.1f} ms, {} rows): {} Args: {} Plan: {}'.format(
+                elapsed * 1000, self._rows, self._sql, self._args, ' | '.join(plan)))
+        self._stats.record(self._sql, elapsed, self._rows, plan)
@@ -0,0 +1,86 @@
+import logging
+import threading
+import time
+
+
+# Results derived from the data (the reports, the homepage statistics, ...),
+# recomputed off the request path whenever the data version changes and
+# swapped in as a whole. tasks maps each result name to the function
+# computing it; context() wraps a refresh (e.g. in an app context) and
+# on_change() runs first when the version differs from the last refresh.
+class Refresher:
+    def __init__(self, version, tasks, context, on_change=None):
+        self.version = version
+        self.tasks = tasks
+        self.context = context
+        self.on_change = on_change
+        # (data version, {name: result}), replaced in a single assignment
+        self._derived = (None, {})
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._status = {'state': 'idle', 'version': None, 'refreshes': 0, 'failures': 0,
+                        'last_started': None, 'last_duration': None, 'durations': {}, 'error': None}
+
+    def get(self, name):
+        return self._derived[1].get(name)
+
+    # Data version of the results served, None before the first refresh
+    def served_version(self):
+        return self._derived[0]
+
+    # True while the results served are those of an older data version
+    def stale(self, version):
+        derived_version = self._derived[0]
+        return derived_version is not None and derived_version != version
+
+    def refresh(self):
+        with self._lock:
+            version = self.version()
+            previous = self._derived[0]
+            started = time.monotonic()
+            self._status.update(state='refreshing', last_started=time.time())
+            results = {}
+            durations = {}
+            try:
+                with self.context():
+                    if previous is not None and version != previous and self.on_change:
+                        self.on_change()
+                    for name, task in self.tasks().items():
+                        task_started = time.monotonic()
+                        results[name] = task()
+                        durations[name] = round(time.monotonic() - task_started, 4)
+            except Exception as e:
+                logging.error(f'Refresh of data version {version} failed: {e}')
+                self._status.update(state='failed', failures=self._status['failures'] + 1, error=str(e))
+                return False
+            self._derived = (version, results)
+            duration = time.monotonic() - started
+            self._status.update(state='idle', version=version, refreshes=self._status['refreshes'] + 1,
+                                last_duration=round(duration, 4), durations=durations, error=None)
+            logging.info('Refreshed {} results of data version {} in {:.2f}s'.format(len(results), version, duration))
+            return True
+
+    # Check the data version every interval seconds (or when woken up) and
+    # refresh when it differs from the one of the current results
+    def run(self, interval):
+        while True:
+            self._wake.wait(interval)
+            self._wake.clear()
+            try:
+                if self.version() != self._derived[0]:
+                    self.refresh()
+            except Exception as e:
+                logging.error(f'Refresh check failed: {e}')
+
+    def start(self, interval):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self.run, args=(interval,), name='refresher', daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def status(self):
+        return dict(self._status, running=self._thread is not None and self._thread.is_alive(),
+                    results=sorted(self._derived[1]))
@@ -0,0 +1,235 @@
+import argparse
+import logging
+import re
+import sqlite3
+
+db_path = "AlunosMatriculados.db"
+
+# SQL for the twelve /queries reports and the homepage statistics and charts.
+# Each report is materialized into a summary table by the loader.
+REPORTS = {
+    'query1': 'SELECT Curso FROM Cursos',
+    'query2': (
+        'SELECT Curso, COUNT(*) AS NumeroMatriculas '
+        'FROM Inscricoes I '
+        'JOIN Cursos C ON I.CODCurso = C.CODCurso '
+        'GROUP BY C.CODCurso'
+    ),
+    'query3': (
+        'SELECT E.Entidade, SUM(I.NumeroAlunosMatriculados) AS TotalAlunos '
+        'FROM Inscricoes I '
+        'JOIN Entidade E ON I.CODEntidade = E.CODEntidade '
+        'GROUP BY E.CODEntidade '
+        'ORDER BY TotalAlunos DESC'
+    ),
+    'query4': (
+        'SELECT DISTINCT I.CODEntidade, Es.Escola, SUM(I.NumeroAlunosMatriculados) AS TotalAlunos '
+        'FROM Entidade E '
+        'JOIN Inscricoes I ON I.CODEntidade = E.CODEntidade '
+        'JOIN Escola Es ON E.CODEscola = Es.CODEscola '
+        'WHERE E.CODNatureza IN (SELECT CODNatureza FROM Natureza WHERE Privado = 1) '
+        # Grouping on the entity drives the join from Entidade, so that only
+        # the enrollments of private entities are read (through the index)
+        'GROUP BY E.CODEntidade'
+    ),
+    'query5': (
+        'SELECT D.distrito, '
+        'count(CASE WHEN N.Privado = 1 THEN E.CODEscola END) AS total_privadas, '
+        'count(CASE WHEN N.Privado = 0 THEN E.CODEscola END) AS total_publicas '
+        'FROM Distrito D '
+        'JOIN Concelho C ON D.CODDistrito = C.CODDistrito '
+        'JOIN Localizacao L ON L.CODConcelho = C.CODConcelho '
+        'JOIN Entidade E ON L.CODEntidade = E.CODEntidade '
+        'JOIN Natureza N ON N.CODNatureza = E.CODNatureza '
+        'GROUP BY D.distrito'
+    ),
+    'query6': (
+        'WITH nrinscritosconcelho AS ('
+        'SELECT C.Concelho, SUM(NumeroAlunosMatriculados) AS TotalAlunos '
+        'FROM Localizacao L '
+        'JOIN Inscricoes I ON L.CODEntidade = I.CODEntidade '
+        'JOIN Concelho C ON L.CODConcelho = C.CODConcelho '
+        'GROUP BY L.CODConcelho) '
+        'SELECT Concelho, MAX(TotalAlunos) FROM nrinscritosconcelho'
+    ),
+    'query7': (
+        'SELECT COUNT(E.CODEscola) AS total_escolas, NII.NUTSII '
+        'FROM Entidade E '
+        'JOIN Localizacao L ON L.CODEntidade = E.CODEntidade '
+        'JOIN Concelho C ON L.CODConcelho = C.CODConcelho '
+        'JOIN NUTSIII NIII ON C.CODNUTSIII = NIII.CODNUTSIII '
+        'JOIN NUTSII NII ON NIII.CODNUTSII = NII.CODNUTSII '
+        'GROUP BY NII.NUTSII '
+        'ORDER BY total_escolas DESC'
+    ),
+    'query8': (
+        'SELECT N.NivelEnsino, SUM(NumeroAlunosMatriculados) AS TotalAlunos '
+        'FROM Inscricoes I '
+        'JOIN Nivelensino N ON I.CODNivelEnsino = N.CODNivelEnsino '
+        'GROUP BY N.CODNivelEnsino'
+    ),
+    'query9': (
+        'SELECT C.Concelho, S.Sexo, SUM(NumeroAlunosMatriculados) AS TotalAlunos '
+        'FROM Localizacao L '
+        'JOIN Inscricoes I ON L.CODEntidade = I.CODEntidade '
+        'JOIN Sexo S ON I.CODSexo = S.CODSexo '
+        'JOIN Concelho C ON L.CODConcelho = C.CODConcelho '
+        'GROUP BY L.CODConcelho, S.CODSexo '
+        # Without it, the order of the groups depends on the join order
+        'ORDER BY L.CODConcelho, S.CODSexo'
+    ),
+    'query10': (
+        'WITH NrAlunos AS ('
+        'SELECT D.CODDistrito, SUM(I.NumeroAlunosMatriculados) AS NumeroAlunosMatriculados '
+        'FROM Inscricoes I '
+        'JOIN Entidade E ON I.CODEntidade = E.CODEntidade '
+        'JOIN Concelho C ON L.CODConcelho = C.CODConcelho '
+        'JOIN Distrito D ON C.CODDistrito = D.CODDistrito '
+        'JOIN Localizacao L ON E.CODEntidade = L.CODEntidade '
+        'GROUP BY D.CODDistrito) '
+        'SELECT D.Distrito, N.Natureza, 100 * SUM(I.NumeroAlunosMatriculados) / NA.NumeroAlunosMatriculados as PCTPublico '
+        'FROM Inscricoes I '
+        'JOIN Entidade E ON I.CODEntidade = E.CODEntidade '
+        'JOIN Concelho C ON L.CODConcelho = C.CODConcelho '
+        'JOIN Distrito D ON C.CODDistrito = D.CODDistrito '
+        'JOIN Localizacao L ON E.CODEntidade = L.CODEntidade '
+        'JOIN NrAlunos NA ON D.CODDistrito = NA.CODDistrito '
+        'JOIN Natureza N ON N.CODNatureza = E.CODNatureza '
+        'WHERE N.Privado = 0 '
+        'GROUP BY D.CODDistrito, N.Natureza '
+        'ORDER BY D.CODDistrito, N.Natureza'
+    ),
+    'query11': (
+        'WITH alunos_por_sexo AS ('
+        'SELECT C.curso, '
+        'sum(CASE WHEN S.Sexo = "Homens" THEN I.NumeroAlunosMatriculados ELSE 0 END) AS total_masculino, '
+        'sum(CASE WHEN S.Sexo = "Mulheres" THEN I.NumeroAlunosMatriculados ELSE 0 END) AS total_feminino '
+        'FROM inscricoes I '
+        'JOIN Cursos C ON I.CODCurso = C.CODCurso '
+        'JOIN Sexo S ON I.CODSexo = S.CODSexo '
+        'GROUP BY C.Curso), '
+        'diferencas AS ('
+        'SELECT curso, abs(total_masculino - total_feminino) AS diferenca '
+        'FROM alunos_por_sexo) '
+        'SELECT curso, diferenca '
+        'FROM diferencas '
+        'WHERE diferenca = (SELECT max(diferenca) FROM diferencas)'
+    ),
+    'query12': (
+        'WITH NrAlunosEntidade AS ('
+        'SELECT C.concelho, E.entidade, SUM(I.NumeroAlunosMatriculados) AS nr_alunos '
+        'FROM Inscricoes I '
+        'JOIN Entidade E ON I.CODEntidade = E.CODEntidade '
+        'JOIN Localizacao L ON E.CODEntidade = L.CODEntidade '
+        'JOIN Concelho C ON L.CODConcelho = C.CODConcelho '
+        'GROUP BY C.CODConcelho, I.CODEntidade) '
+        'SELECT Concelho, Entidade, MAX(nr_alunos) as MAXAlunos '
+        'FROM NrAlunosEntidade '
+        'GROUP BY Concelho '
+        'ORDER BY MAXAlunos DESC'
+    ),
+    # Homepage row counts, gathered in a single statement
+    'estatisticas': (
+        'SELECT '
+        '(SELECT COUNT(*) FROM Entidade) AS n_entidades, '
+        '(SELECT COUNT(*) FROM AnoLetivo) AS n_anos, '
+        '(SELECT COUNT(*) FROM Cursos) AS n_cursos, '
+        '(SELECT COUNT(*) FROM Oferta) AS n_ofertas, '
+        '(SELECT COUNT(*) FROM Organizacao) AS n_organizacoes, '
+        '(SELECT COUNT(*) FROM NivelEnsino) AS n_niveis, '
+        '(SELECT COUNT(*) FROM Orientacao) AS n_orientacoes, '
+        '(SELECT COUNT(*) FROM CicloEstudos) AS n_ciclos, '
+        '(SELECT COUNT(*) FROM Sexo) AS n_sexos, '
+        '(SELECT COUNT(*) FROM Concelho) AS n_concelhos, '
+        '(SELECT COUNT(*) FROM Distrito) AS n_distritos, '
+        '(SELECT COUNT(*) FROM NUTSII) AS n_nutsii, '
+        '(SELECT COUNT(*) FROM NUTSIII) AS n_nutsiii, '
+        '(SELECT COUNT(*) FROM AnoEscolaridade) AS n_anoEscolaridade, '
+        '(SELECT sum(NumeroAlunosMatriculados) FROM Inscricoes) AS n_inscricoes, '
+        '(SELECT COUNT(*) FROM Localizacao) AS n_localizacao, '
+        '(SELECT COUNT(*) FROM Escola) AS n_escola, '
+        '(SELECT COUNT(*) FROM Agrupamento) AS n_agrupamento, '
+        '(SELECT COUNT(*) FROM EscolaSede) AS n_EscolaSede'
+    ),
+    # Homepage charts (/data, /sexo and /natureza)
+    'niveis': (
+        'SELECT N.NivelEnsino, SUM(NumeroAlunosMatriculados) AS TotalAlunos '
+        'FROM Inscricoes I '
+        'JOIN Nivelensino N ON I.CODNivelEnsino = N.CODNivelEnsino '
+        'GROUP BY N.CODNivelEnsino'
+    ),
+    'sexo': (
+        'SELECT sexo.sexo, sum(inscricoes.NumeroAlunosMatriculados) AS total_inscritos FROM sexo '
+        'JOIN inscricoes ON inscricoes.codsexo = sexo.codsexo '
+        'GROUP BY sexo.codsexo'
+    ),
+    'natureza': (
+        'SELECT N.Natureza, count(E.CODEntidade) AS TotalEntidades FROM Entidade E '
+        'LEFT JOIN Natureza N ON N.CODNatureza = E.CODNatureza '
+        'GROUP BY N.Natureza'
+    ),
+}
+
+SUMMARY_PREFIX = 'Resumo_'
+
+
+def summary_table(name):
+    return SUMMARY_PREFIX + name
+
+
+def refresh_summaries(conn):
+    # Rebuild every summary table in a single transaction, so readers
+    # see either the old or the new set of reports, never a mix
+    conn.execute('BEGIN')
+    try:
+        for name, sql in REPORTS.items():
+            table = summary_table(name)
+            conn.execute(f'DROP TABLE IF EXISTS {table}')
+            conn.execute(f'CREATE TABLE {table} AS {sql}')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    logging.info('Refreshed {} summary tables'.format(len(REPORTS)))
+
+
+def explain(conn):
+    # Print the query plan of every report and flag the SCAN steps over the
+    # Inscricoes fact table: full table scans, and full scans of one of its
+    # indexes, which avoid the table but still read an entry per row. Only
+    # SEARCH steps seek into the fact table. (Scanning a small dimension
+    # table to drive a join is expected.)
+    full_scans = 0
+    index_scans = 0
+    for name, sql in REPORTS.items():
+        fact = {'inscricoes'} | {alias.lower() for alias in re.findall(r'\bInscricoes\s+(?!ON\b)(\w+)', sql, re.I)}
+        print(f'== {name}')
+        for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}'):
+            detail = row[3]
+            words = detail.split()
+            flag = ''
+            if words[0] == 'SCAN' and words[1].lower() in fact:
+                if 'INDEX' in detail:
+                    flag = '   <-- full index scan of Inscricoes'
+                    index_scans += 1
+                else:
+                    flag = '   <-- full scan of Inscricoes'
+                    full_scans += 1
+            print(f'   {detail}{flag}')
+    print(f'{full_scans} full table scans and {index_scans} full index scans of Inscricoes in {len(REPORTS)} reports')
+    return full_scans + index_scans
+
+
+# Refresh the summary tables of an existing database after its data changed,
+# or print the query plans of the reports
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    parser = argparse.ArgumentParser(description='Refresh the report summary tables')
+    parser.add_argument('--explain', action='store_true', help='print EXPLAIN QUERY PLAN for each report instead')
+    args = parser.parse_args()
+    conn = sqlite3.connect(db_path)
+    if args.explain:
+        explain(conn)
+    else:
+        refresh_summaries(conn)
+    conn.close()
@@ -0,0 +1,100 @@
+import logging
+import threading
+from collections import namedtuple
+
+# columns: column names in table order
+# primary_key: primary key columns, in key order
+# key: column used for keyset pagination and record lookups (the INTEGER
+#      primary key, or the rowid for tables with a composite key)
+# foreign_keys: {column: (referenced table, referenced column)}
+# label: column naming a record (the first one outside the primary and
+#        foreign keys), or None
+# links: {column: table} for the columns whose value is the key of a record
+#        of that table (the table's own key and its foreign keys)
+Table = namedtuple('Table', 'name columns primary_key key foreign_keys label links')
+
+
+def introspect(conn):
+    tables = {}
+    rows = conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY name").fetchall()
+    # Virtual tables (the full-text index) and their shadow tables are not browsable
+    virtual = [row[0] for row in rows if row[1].upper().startswith('CREATE VIRTUAL TABLE')]
+    names = [row[0] for row in rows
+             if row[0] not in virtual and not any(row[0].startswith(f'{name}_') for name in virtual)]
+    for name in names:
+        info = conn.execute(f'PRAGMA table_info({name})').fetchall()
+        columns = [column[1] for column in info]
+        pk = sorted((column for column in info if column[5]), key=lambda column: column[5])
+        primary_key = [column[1] for column in pk]
+        key = pk[0][1] if len(pk) == 1 and pk[0][2].upper() == 'INTEGER' else 'rowid'
+        references = {}
+        for fk in conn.execute(f'PRAGMA foreign_key_list({name})'):
+            # fk: id, seq, table, from, to, on_update, on_delete, match
+            references[fk[3]] = (fk[2], fk[4])
+        foreign_keys = {column: references[column] for column in columns if column in references}
+        label = next((column for column in columns if column not in primary_key and column not in references), None)
+        tables[name] = Table(name, columns, primary_key, key, foreign_keys, label, {})
+    # A reference without a column points at the primary key of its table
+    for name, table in tables.items():
+        for column, (ref_table, ref_column) in table.foreign_keys.items():
+            if ref_column is None and ref_table in tables:
+                table.foreign_keys[column] = (ref_table, tables[ref_table].key)
+        if table.key != 'rowid':
+            table.links[table.key] = name
+        for column, (ref_table, ref_column) in table.foreign_keys.items():
+            if ref_table in tables and tables[ref_table].key == ref_column:
+                table.links[column] = ref_table
+    return tables
+
+
+# Tables, columns, primary and foreign keys of the database, read once and
+# kept until clear() is called (on the reload signal)
+class SchemaRegistry:
+    def __init__(self):
+        self._tables = None
+        self._lock = threading.Lock()
+
+    def tables(self, connect):
+        tables = self._tables
+        if tables is None:
+            with self._lock:
+                if self._tables is None:
+                    self._tables = introspect(connect())
+                    logging.info('Loaded schema of {} tables'.format(len(self._tables)))
+                tables = self._tables
+        return tables
+
+    def clear(self):
+        self._tables = None
+
+
+# Tables with a foreign key to table: (child table, column) pairs
+def children(tables, table):
+    return [(child, column) for child in tables.values()
+            for column, (ref_table, _) in child.foreign_keys.items() if ref_table == table.name]
+
+
+# Labels by code of the small referenced tables (Sexo, NivelEnsino, ...),
+# read once per table and kept until clear(); None for tables with more
+# than max_rows rows, which are joined instead. The codes are kept as text:
+# a VARCHAR foreign key ('1') must find the label of an INTEGER key (1)
+class LookupStore:
+    def __init__(self):
+        self._lookups = {}
+        self._lock = threading.Lock()
+
+    def get(self, table, column, label, connect, max_rows):
+        key = (table, column)
+        lookups = self._lookups
+        if key in lookups:
+            return lookups[key]
+        rows = connect().execute(f'SELECT {column}, {label} FROM {table} LIMIT ?', (max_rows + 1,)).fetchall()
+        lookup = {str(row[0]): row[1] for row in rows} if len(rows) <= max_rows else None
+        with self._lock:
+            self._lookups[key] = lookup
+        return lookup
+
+    def clear(self):
+        with self._lock:
+            self._lookups = {}
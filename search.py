@@ -0,0 +1,73 @@
+import argparse
+import logging
+import re
+import sqlite3
+
+db_path = "AlunosMatriculados.db"
+
+SEARCH_TABLE = 'Pesquisa'
+
+# Tables searched by name: (table, code column, name column)
+SEARCHED = [
+    ('Escola', 'CODEscola', 'Escola'),
+    ('Entidade', 'CODEntidade', 'Entidade'),
+    ('Agrupamento', 'CODAgrupamento', 'Agrupamento'),
+    ('Cursos', 'CODCurso', 'Curso'),
+]
+
+# unicode61 with remove_diacritics 2 folds case and accents, so "sao" finds
+# "São"; the prefix indexes keep short autocomplete prefixes cheap
+CREATE_SEARCH_SQL = (
+    f'CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5('
+    'Nome, Tabela UNINDEXED, Codigo UNINDEXED, '
+    "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3 4')"
+)
+
+_WORDS = re.compile(r'\w+')
+
+
+def build_search_index(conn):
+    # Rebuild the index in a single transaction, from every searched table
+    conn.execute('BEGIN')
+    try:
+        conn.execute(f'DROP TABLE IF EXISTS {SEARCH_TABLE}')
+        conn.execute(CREATE_SEARCH_SQL)
+        for table, code, name in SEARCHED:
+            conn.execute(f"INSERT INTO {SEARCH_TABLE} (Nome, Tabela, Codigo) "
+                         f"SELECT {name}, '{table}', {code} FROM {table} WHERE {name} IS NOT NULL")
+        conn.execute(f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('optimize')")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    count = conn.execute(f'SELECT COUNT(*) FROM {SEARCH_TABLE}').fetchone()[0]
+    logging.info('Built search index of {} names'.format(count))
+
+
+# FTS5 query for the words typed by the user: every word must match as a
+# prefix, each one quoted so that no FTS syntax gets through. None when there
+# is nothing to search for.
+def match_query(text):
+    words = _WORDS.findall(text)
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+# Names matching the query, best first (bm25), optionally in one table
+def search_sql(table=None):
+    where = f'{SEARCH_TABLE} MATCH ?'
+    if table:
+        where += ' AND Tabela = ?'
+    return (f'SELECT Nome, Tabela, Codigo FROM {SEARCH_TABLE} '
+            f'WHERE {where} ORDER BY rank LIMIT ? OFFSET ?')
+
+
+# Rebuild the search index of an existing database
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    parser = argparse.ArgumentParser(description='Rebuild the full-text search index')
+    parser.parse_args()
+    conn = sqlite3.connect(db_path)
+    build_search_index(conn)
+    conn.close()
@@ -0,0 +1,56 @@
+import argparse
+import os
+
+from gunicorn.app.base import BaseApplication
+
+import app
+
+# Production entry point: the app under gunicorn, preloaded and warmed up in
+# the master process, then forked into worker processes that share its
+# schema, caches and columnar engine copy-on-write. create_db.py signals the
+# master through PID_FILE, which warms up again and replaces the workers.
+
+
+def on_reload(arbiter):
+    app.invalidate_caches()
+    app.warm_up()
+    app.POOL.close_all()
+
+
+# Threads do not survive fork(): each worker starts its own refresher, from
+# the results computed by the master
+def post_fork(server, worker):
+    app.REFRESHER.start(app.APP.config['REFRESH_INTERVAL'])
+
+
+class Server(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for name, value in self.options.items():
+            self.cfg.set(name, value)
+
+    def load(self):
+        app.warm_up()
+        # SQLite connections must not cross fork(): every worker opens its own
+        app.POOL.close_all()
+        return app.APP
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the app with gunicorn')
+    parser.add_argument('--bind', default='0.0.0.0:9001', help='address:port to listen on')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='worker processes')
+    parser.add_argument('--threads', type=int, default=4, help='threads per worker')
+    args = parser.parse_args()
+    Server({
+        'bind': args.bind,
+        'workers': args.workers,
+        'threads': args.threads,
+        'preload_app': True,
+        'pidfile': app.PID_FILE,
+        'on_reload': on_reload,
+        'post_fork': post_fork,
+    }).run()
@@ -0,0 +1,144 @@
+import json
+import logging
+import os
+import re
+import threading
+import zlib
+
+try:
+    import brotli
+except ImportError:  # brotli snapshots are only written when it is installed
+    brotli = None
+
+# Pages identical between two loads and expensive to render, pre-rendered to
+# compressed files by the export-snapshots command
+SNAPSHOT_URLS = [
+    '/',
+    '/queries',
+    '/list/Inscricoes/',
+    '/list/Inscricoes/?all=1',
+    '/data',
+    '/sexo',
+    '/natureza',
+    '/api/charts',
+]
+
+MANIFEST = 'manifest.json'
+
+# Content-Encoding of each file variant, in order of preference
+ENCODINGS = [('br', '.br'), ('gzip', '.gz'), ('identity', '')]
+
+
+def file_name(url):
+    return re.sub(r'[^A-Za-z0-9]+', '_', url).strip('_') or 'index'
+
+
+def write_atomic(path, data):
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+
+# Write chunks to path uncompressed, gzipped (as the app compresses live
+# responses, so that both carry the same bytes under the same ETag) and,
+# with brotli installed, brotli-compressed, one chunk at a time. Returns the
+# encodings written and the uncompressed size.
+def write_encoded(path, chunks, gzip_level):
+    gzipper = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+    # encoding: (file extension, compress a chunk, compress what is left)
+    variants = {'identity': ('', lambda chunk: chunk, lambda: b''),
+                'gzip': ('.gz', gzipper.compress, gzipper.flush)}
+    if brotli:
+        compressor = brotli.Compressor()
+        variants['br'] = ('.br', compressor.process, compressor.finish)
+    files = {encoding: open(path + extension + '.tmp', 'wb') for encoding, (extension, _, _) in variants.items()}
+    size = 0
+    try:
+        for chunk in chunks:
+            size += len(chunk)
+            for encoding, (_, compress, _) in variants.items():
+                files[encoding].write(compress(chunk))
+        for encoding, (_, _, flush) in variants.items():
+            files[encoding].write(flush())
+    finally:
+        for f in files.values():
+            f.close()
+    for extension, _, _ in variants.values():
+        os.replace(path + extension + '.tmp', path + extension)
+    return list(variants), size
+
+
+# Snapshot files and their manifest: the data version they were rendered
+# from and, per URL, the file name and content type. The manifest is read
+# again whenever its file changes.
+class SnapshotStore:
+    def __init__(self, directory):
+        self.directory = directory
+        self._manifest = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def manifest(self):
+        path = os.path.join(self.directory, MANIFEST)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        if mtime != self._mtime:
+            with self._lock:
+                try:
+                    with open(path) as f:
+                        self._manifest = json.load(f)
+                except (OSError, ValueError) as e:
+                    logging.warning(f'Snapshot manifest unreadable: {e}')
+                    self._manifest = None
+                self._mtime = mtime
+        return self._manifest
+
+    # File, Content-Encoding and content type of the snapshot of url for a
+    # client accepting the given encodings, or None when there is no
+    # snapshot of the current data version
+    def lookup(self, url, version, accepts):
+        manifest = self.manifest()
+        if not manifest or manifest['version'] != version:
+            return None
+        entry = manifest['urls'].get(url)
+        if entry is None:
+            return None
+        for encoding, extension in ENCODINGS:
+            if encoding in entry['encodings'] and (encoding == 'identity' or accepts(encoding)):
+                return os.path.join(self.directory, entry['file'] + extension), encoding, entry['content_type']
+        return None
+
+    # Render every URL with the given test client and write it uncompressed,
+    # gzipped at gzip_level and (with brotli installed) brotli-compressed,
+    # streaming the body so that the largest pages are never held in memory
+    def export(self, client, version, gzip_level, urls=SNAPSHOT_URLS):
+        os.makedirs(self.directory, exist_ok=True)
+        # Without a manifest, the pages below are rendered live
+        manifest_path = os.path.join(self.directory, MANIFEST)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        self.clear()
+        manifest = {'version': version, 'urls': {}}
+        for url in urls:
+            response = client.get(url, headers={'Accept-Encoding': 'identity'}, buffered=False)
+            try:
+                # Only complete pages of this data version carry an ETag
+                if response.status_code != 200 or 'ETag' not in response.headers:
+                    logging.warning(f'Snapshot of {url} skipped: status {response.status_code}')
+                    continue
+                name = file_name(url)
+                encodings, size = write_encoded(os.path.join(self.directory, name), response.iter_encoded(),
+                                                gzip_level)
+            finally:
+                response.close()
+            manifest['urls'][url] = {'file': name, 'content_type': response.content_type,
+                                     'encodings': encodings}
+            logging.info(f'Snapshot of {url}: {size} bytes')
+        write_atomic(manifest_path, json.dumps(manifest, indent=2).encode())
+        return manifest
+
+    def clear(self):
+        self._manifest = None
+        self._mtime = None
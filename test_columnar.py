@@ -0,0 +1,33 @@
+import sqlite3
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('pandas')
+
+import benchmark
+import columnar
+import create_db
+
+
+# A small synthetic database, loaded like create_db.py does, in memory
+@pytest.fixture(scope='module')
+def conn():
+    conn = sqlite3.connect(':memory:')
+    conn.executescript(create_db.create_tables_sql)
+    create_db.fill_db(conn, benchmark.synthetic_chunks(3000, chunk_size=1000))
+    create_db.create_indexes(conn)
+    yield conn
+    conn.close()
+
+
+@pytest.fixture(scope='module')
+def engine(conn):
+    return columnar.ColumnarEngine(conn)
+
+
+@pytest.mark.parametrize('name', columnar.ENGINE_REPORTS)
+def test_engine_matches_sql(conn, engine, name):
+    expected, actual = columnar.compare(conn, engine, name)
+    assert expected
+    assert actual == expected